@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+#
+# ==================================================================
+#
+# Copyright (c) 2016, Parallels IP Holdings GmbH
+# Released under the terms of MIT license (see LICENSE for details)
+#
+# ==================================================================
+#
+'''
+Benchmarks for githooks
+
+bench.py [startup]: time a bare interpreter, imports of the heavy
+modules githooks may need and complete githooks runs in new processes:
+
+    $ ./bench.py --ini testhooks.ini --conf /path/to/hooks.conf \\
+                 --repo /path/to/repo.git [--refs refs.txt] [--socket githooks.sock]
+
+'refs.txt' holds stdin lines as passed by Stash (old_sha new_sha ref);
+with no refs githooks only starts up. With --socket, runs through
+githooks_client.py and a `githooks.py --serve` server are timed too.
+
+bench.py repo: generate a repository with a push of a given scale and
+time Githooks.run, each hook and the hookutil git parsers on it:
+
+    $ ./bench.py repo --commits 100 --files 10 --blob-size 4096 \\
+                 --branches 4 --merges 0.1 --output results.json
+
+Results are printed and saved as JSON with the parameters, so that
+runs on different versions can be compared.
+'''
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import platform
+import subprocess
+import StringIO
+from optparse import OptionParser
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RUN = ('import sys; sys.argv = sys.argv[1:]; import githooks; '
+       'githooks.Githooks(conf_file=sys.argv[0], ini_file=sys.argv[1], repo_dir=sys.argv[2]).run(sys.argv[3:])')
+
+IMPORTS = [
+    ('import yaml', 'yaml'),
+    ('import smtplib, email', 'smtplib; from email.MIMEMultipart import MIMEMultipart; '
+                              'from email.MIMEText import MIMEText'),
+    ('import pycodestyle', 'pycodestyle'),
+    ('import githooks', 'githooks'),
+    ('import hookutil', 'sys; sys.path.insert(0, "hooks.d"); import hookutil'),
+]
+
+# Hooks run on the generated push; mail goes to the spool only
+HOOKS = {
+    'line_endings': [],
+    'copyright': [{'start': 'Copyright ', 'full': 'Copyright .*%Y Bench'}],
+    'pep8hook': {'ignore': ['E501']},
+    'rejectmerge': [],
+    'notify': ['refs/heads/.*'],
+    'email_mention': []
+}
+
+INI = '''[DEFAULT]
+log_file = %(dir)s/githooks.log
+log_level = WARNING
+conf_dir = %(dir)s
+hooks_dir = %(hooks_dir)s
+verdict_cache_size = 0
+stats_file = %(dir)s/stats.json
+jobs = %(jobs)d
+
+user_name = bench
+base_url = http://STASH
+proj_key = BENCH
+repo_name = bench
+smtp_server = 127.0.0.1
+smtp_port = 1
+smtp_from = bench@example.com
+mail_spool_dir = %(dir)s/spool
+email_domain = example.com
+'''
+
+
+def summary(times):
+    '''
+    Summarize a list of times in seconds.
+    '''
+    times = sorted(times)
+    return {'runs': len(times), 'min': times[0], 'median': times[len(times) // 2],
+            'mean': sum(times) / len(times), 'max': times[-1]}
+
+
+def report(results, name, times):
+    results[name] = summary(times)
+    print >> sys.stderr, "%-32s min %9.1f ms  median %9.1f ms" % (
+        name, results[name]['min'] * 1000, results[name]['median'] * 1000)
+
+
+def measure(cmd, repeat, cwd=ROOT_DIR, env=None, stdin=None):
+    '''
+    Run 'cmd' 'repeat' times, return the wall times in seconds.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate(stdin or '')
+        times.append(time.time() - start)
+
+        # githooks exits with 1 when a hook rejects the push
+        if proc.returncode not in (0, 1):
+            raise RuntimeError("'%s' failed: %s" % (' '.join(cmd), err))
+
+    return times
+
+
+def bench_startup(options, results):
+    if not options.conf:
+        raise RuntimeError('--conf is required')
+
+    stdin = ''
+    if options.refs:
+        with open(options.refs) as f:
+            stdin = f.read()
+
+    python = sys.executable
+    repeat = options.repeat
+    repo = os.path.abspath(options.repo)
+
+    report(results, 'python', measure([python, '-c', 'pass'], repeat))
+    for name, module in IMPORTS:
+        try:
+            report(results, name, measure([python, '-c', 'import ' + module], repeat))
+        except RuntimeError:
+            print >> sys.stderr, "%-32s not available" % name
+
+    report(results, 'githooks', measure([python, '-c', RUN, options.conf, options.ini, repo],
+                                        repeat, stdin=stdin))
+
+    if options.socket:
+        env = dict(os.environ, GITHOOKS_SOCKET=os.path.abspath(options.socket))
+        report(results, 'githooks_client',
+               measure([python, os.path.join(ROOT_DIR, 'githooks_client.py'), options.conf],
+                       repeat, cwd=repo, env=env, stdin=stdin))
+
+
+def git(cmd, repo, input=None):
+    proc = subprocess.Popen(['git'] + cmd, cwd=repo, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(input)
+    if proc.returncode != 0:
+        raise RuntimeError("'git %s' failed: %s" % (' '.join(cmd), err))
+    return out
+
+
+def make_blob(rnd, path, size):
+    '''
+    Generate 'size' bytes of contents for file 'path'.
+    '''
+    if path.endswith('.py'):
+        lines = ['# Copyright 2001-2017 Bench\n'] + ['x%d = [%d, %d]\n' % (i, rnd.randint(0, 999), i)
+                                                      for i in range(size // 16 + 1)]
+    else:
+        lines = ['Copyright 2001-2017 Bench\n'] + ['line %d %s @user%d\n' % (i, 'x' * rnd.randint(0, 40), i % 7)
+                                                    for i in range(size // 32 + 1)]
+
+    return ''.join(lines)[:size]
+
+
+def make_repo(options, repo):
+    '''
+    Create bare repository 'repo' with a base commit on branches
+    bench/0..branches-1 and a push on top of each of them, of 'commits'
+    commits changing 'files' files of 'blob_size' bytes, some of
+    them merges. The pushed commits are not referenced, as in a
+    pre-receive hook. Return the stdin lines for githooks.
+    '''
+    rnd = random.Random(options.seed)
+    git(['init', '--bare', '-q', repo], None)
+
+    stream = []
+    mark = [0]
+
+    def blob(data):
+        mark[0] += 1
+        stream.append('blob\nmark :%d\ndata %d\n%s\n' % (mark[0], len(data), data))
+        return mark[0]
+
+    def commit(ref, message, files, parents):
+        blobs = [(path, blob(data)) for path, data in files]
+        mark[0] += 1
+        stream.append('commit %s\nmark :%d\ncommitter Bench <bench@example.com> %d +0000\n'
+                      'data %d\n%s\n' % (ref, mark[0], 1500000000 + mark[0], len(message), message))
+        if parents:
+            stream.append('from :%d\n' % parents[0])
+        for parent in parents[1:]:
+            stream.append('merge :%d\n' % parent)
+        for path, blob_mark in blobs:
+            stream.append('M 100644 :%d %s\n' % (blob_mark, path))
+        stream.append('\n')
+        return mark[0]
+
+    extensions = ['.py', '.txt', '.c']
+    paths = ['dir%d/file%d%s' % (i % 10, i, extensions[i % len(extensions)])
+             for i in range(max(options.files * 4, 1))]
+
+    attributes = ('*.py owners=python@example.com\n'
+                  '*.c owners=c@example.com\n'
+                  'dir1/** owners=dir1@example.com\n')
+    base = commit('refs/heads/master', 'Base commit',
+                  [('.gitattributes', attributes)] + [(path, make_blob(rnd, path, options.blob_size))
+                                                        for path in paths], [])
+
+    tips = []
+    for ref in range(options.branches):
+        branch = 'refs/heads/bench/%d' % ref
+        history = [base]
+        for i in range(options.commits):
+            files = [(path, make_blob(rnd, path, options.blob_size))
+                     for path in rnd.sample(paths, min(options.files, len(paths)))]
+            parents = [history[-1]]
+
+            # Merge a commit made off an earlier one
+            if len(history) > 2 and rnd.random() < options.merges:
+                side = commit('refs/bench/side', 'Side commit %d @user%d' % (i, i % 7), files[:1],
+                              [rnd.choice(history[:-1])])
+                parents.append(side)
+                files = files[1:]
+
+            history.append(commit('refs/bench/push%d' % ref, 'Commit %d on %s @user%d' % (i, branch, i % 7),
+                                  files, parents))
+        tips.append((branch, history[-1]))
+
+    stream.append(''.join('reset refs/heads/bench/%d\nfrom :%d\n\n' % (ref, base) for ref in range(options.branches)))
+    git(['fast-import', '--quiet', '--export-marks=marks'], repo, ''.join(stream))
+
+    with open(os.path.join(repo, 'marks')) as f:
+        marks = dict(line.split() for line in f)
+
+    # Leave the pushed commits unreferenced
+    for ref in git(['for-each-ref', '--format=%(refname)', 'refs/bench/'], repo).split():
+        git(['update-ref', '-d', ref], repo)
+
+    base_sha = marks[':%d' % base]
+    return ''.join('%s %s %s\n' % (base_sha, marks[':%d' % tip], branch) for branch, tip in tips)
+
+
+def bench_repo(options, results):
+    sys.path.insert(0, ROOT_DIR)
+    import githooks
+
+    workdir = tempfile.mkdtemp(prefix='githooks-bench-')
+    try:
+        repo = os.path.join(workdir, 'repo.git')
+
+        start = time.time()
+        stdin = make_repo(options, repo)
+        print >> sys.stderr, "Generated the repository in %.1f s" % (time.time() - start)
+
+        stdin_file = os.path.join(workdir, 'stdin')
+        with open(stdin_file, 'w') as f:
+            f.write(stdin)
+        with open(os.path.join(workdir, 'bench.conf'), 'w') as f:
+            f.write(json.dumps(HOOKS))
+        with open(os.path.join(workdir, 'bench.ini'), 'w') as f:
+            f.write(INI % {'dir': workdir, 'hooks_dir': os.path.join(ROOT_DIR, 'hooks.d'),
+                           'jobs': options.jobs})
+
+        gh = githooks.Githooks(conf_file='bench.conf', ini_file=os.path.join(workdir, 'bench.ini'),
+                               repo_dir=repo)
+
+        import hookutil
+
+        # githooks.run, hooks as reported by its statistics
+        times, hooks = [], {}
+        for _ in range(options.repeat):
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            start = time.time()
+            try:
+                gh.run([stdin_file])
+            except SystemExit:
+                pass
+            finally:
+                sys.stdout = stdout
+            times.append(time.time() - start)
+
+            # Keep the caches of one run from the next
+            for memoized in hookutil._memoized:
+                memoized.clear()
+
+        report(results, 'Githooks.run', times)
+
+        with open(os.path.join(workdir, 'stats.json')) as f:
+            for line in f:
+                for hook, timing in json.loads(line)['hooks'].items():
+                    hooks.setdefault(hook, []).append(timing['wall'])
+        for hook, times in sorted(hooks.items()):
+            report(results, 'hook ' + hook, times)
+
+        # hookutil parsers, one call per pushed ref or commit
+        refs = [line.split() for line in stdin.splitlines()]
+
+        def timed(function):
+            times = []
+            for _ in range(options.repeat):
+                start = time.time()
+                function()
+                times.append(time.time() - start)
+                for memoized in hookutil._memoized:
+                    memoized.clear()
+                hookutil.cleanup()
+            return times
+
+        logs = [hookutil.parse_git_log(repo, ref, old_sha, new_sha) for old_sha, new_sha, ref in refs]
+        commits = [commit['commit'] for log in logs for commit in log]
+        paths = sorted(set(modfile['path'] for commit in commits
+                           for modfile in hookutil.parse_git_show(repo, commit)))
+
+        report(results, 'parse_git_log', timed(
+            lambda: [hookutil.parse_git_log(repo, ref, old_sha, new_sha, this_branch_only=False)
+                     for old_sha, new_sha, ref in refs]))
+        report(results, 'parse_git_show', timed(
+            lambda: [hookutil.parse_git_show(repo, commit) for commit in commits]))
+        report(results, 'get_attr', timed(
+            lambda: [hookutil.get_attr(repo, refs[0][1], path, 'owners') for path in paths]))
+        report(results, 'get_attrs', timed(
+            lambda: hookutil.get_attrs(repo, refs[0][1], paths, ['owners'])))
+        report(results, 'match_attr', timed(
+            lambda: hookutil.match_attr(repo, refs[0][1], paths, 'owners')))
+    finally:
+        if options.keep:
+            print >> sys.stderr, "Kept the workspace in '%s'" % workdir
+        else:
+            shutil.rmtree(workdir)
+
+
+def main():
+    parser = OptionParser(usage='%prog [startup|repo] [options]')
+    parser.add_option('-n', '--repeat', type='int', default=10, help='runs per measurement (10)')
+    parser.add_option('-o', '--output', help='file to save the results to as JSON (stdout)')
+
+    # startup
+    parser.add_option('--ini', default='githooks.ini', help='startup: githooks .ini file (githooks.ini)')
+    parser.add_option('--conf', help='startup: hooks configuration file, relative to conf_dir')
+    parser.add_option('--repo', default=os.getcwd(), help='startup: repository to run the hooks in (cwd)')
+    parser.add_option('--refs', help='startup: file with refs to pass on stdin (none)')
+    parser.add_option('--socket', help='startup: githooks server socket, to time githooks_client.py')
+
+    # repo
+    parser.add_option('--commits', type='int', default=20, help='repo: commits per pushed ref (20)')
+    parser.add_option('--files', type='int', default=10, help='repo: files changed per commit (10)')
+    parser.add_option('--blob-size', type='int', default=4096, help='repo: size of each file (4096)')
+    parser.add_option('--branches', type='int', default=1, help='repo: number of pushed branches (1)')
+    parser.add_option('--merges', type='float', default=0.0, help='repo: share of merge commits (0.0)')
+    parser.add_option('--jobs', type='int', default=1, help='repo: githooks jobs setting (1)')
+    parser.add_option('--seed', type='int', default=0, help='repo: random seed (0)')
+    parser.add_option('--keep', action='store_true', help='repo: keep the generated workspace')
+
+    options, args = parser.parse_args()
+    args = args or ['startup']
+    if len(args) != 1 or args[0] not in ('startup', 'repo'):
+        parser.error('startup or repo benchmark expected')
+
+    results = {}
+    try:
+        if args[0] == 'startup':
+            bench_startup(options, results)
+        else:
+            bench_repo(options, results)
+    except RuntimeError as err:
+        parser.error(str(err))
+
+    revision = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].strip()
+    output = json.dumps({
+        'benchmark': args[0],
+        'time': time.time(),
+        'revision': revision or None,
+        'python': platform.python_version(),
+        'git': git(['--version'], None).strip(),
+        'options': vars(options),
+        'results': results
+    }, indent=4, sort_keys=True)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -22,10 +22,166 @@ https://github.com/ngsru/atlassian-external-hooks/wiki/Configuration
 
 import os
 import sys
-import yaml
 import ConfigParser
+import cPickle
+import tempfile
 import fileinput
 import logging
+import Queue
+import threading
+import atexit
+import time
+import json
+import signal
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Pass log records to 'handler' through a queue, so that a
+    background thread does the formatting and writing.
+    '''
+    def __init__(self, handler):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.__serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        # Merge the arguments in now, they may change later
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.queue.put(record)
+
+    def __serve(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+
+    def after_fork(self):
+        '''
+        Restart the writer thread in a forked child.
+        '''
+        self.handler.createLock()
+        self.createLock()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.__serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.handler.close()
+        logging.Handler.close(self)
+
+
+def load_cached(path, parse, warnings=None):
+    '''
+    Return parse(path), cached in a pickle next to 'path' as long as
+    the file's mtime, size and inode stay the same.
+
+    A cache that can not be written is logged as a warning, or added
+    to 'warnings' if given, e.g. when logging is not configured yet.
+    '''
+    st = os.stat(path)
+    key = (st.st_mtime, st.st_size, st.st_ino)
+
+    dirname, basename = os.path.split(os.path.abspath(path))
+    cache_path = os.path.join(dirname, '.%s.pickle' % basename)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, data = cPickle.load(f)
+        if cached_key == key:
+            return data
+    except Exception:
+        # No cache yet, or a broken one
+        pass
+
+    data = parse(path)
+
+    # Write to a temporary file and rename it for concurrent pushes
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=basename + '.')
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump((key, data), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as err:
+        message = "Could not cache '%s': %s" % (path, str(err))
+        if warnings is None:
+            logging.warning(message)
+        else:
+            warnings.append(message)
+
+    return data
+
+
+def parse_conf_file(conf_path):
+    '''
+    Parse YAML configuration file 'conf_path'.
+    '''
+    # yaml takes long to import, only do it when the cache is stale
+    import yaml
+
+    with open(conf_path) as f:
+        conf = yaml.load(f.read(), Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    if not isinstance(conf, dict):
+        raise RuntimeError("Invalid configuration in '%s': hooks are expected" % conf_path)
+
+    return conf
+
+
+def parse_ini_file(ini_path):
+    '''
+    Parse .ini file 'ini_path' into its raw [DEFAULT] options and
+    a dictionary of section options, not interpolated.
+    '''
+    raw = ConfigParser.RawConfigParser()
+    with open(ini_path) as f:
+        raw.readfp(f)
+
+    return raw.defaults(), dict((section, raw.items(section)) for section in raw.sections())
+
+
+class LazyHook(object):
+    '''
+    Import hook module 'name' from hooks_dir and create its Hook
+    on first use. Attributes are those of the Hook.
+    '''
+    def __init__(self, name, repo_dir, settings, params):
+        self.__dict__.update({
+            'name': name,
+            '_LazyHook__args': (repo_dir, settings, params),
+            '_LazyHook__hook': None,
+            '_LazyHook__lock': threading.Lock()
+        })
+
+    def __load(self):
+        with self.__lock:
+            if self.__hook is None:
+                try:
+                    module = __import__(self.name)
+                except ImportError as err:
+                    message = "Could not load hook: '%s' (%s)" % (self.name, str(err))
+                    logging.error(message)
+                    raise RuntimeError(message)
+                self.__dict__['_LazyHook__hook'] = module.Hook(*self.__args)
+
+        return self.__hook
+
+    def __getattr__(self, attr):
+        return getattr(self.__load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.__load(), attr, value)
 
 
 class Githooks(object):
@@ -35,18 +191,22 @@ class Githooks(object):
     def __init__(self, conf_file, ini_file, repo_dir=os.getcwd()):
         self.this_file_path = os.path.dirname(unicode(__file__, sys.getfilesystemencoding()))
 
-        self.ini = self.__load_ini_file(ini_file)
+        # Logging is configured by the .ini, so log its warnings later
+        warnings = []
+        self.ini = self.__load_ini_file(ini_file, warnings)
         self.configure_defaults()
 
         # Set up logging
-        logging.basicConfig(format='%(asctime)s %(levelname)s [%(filename)s:%(lineno)d %(process)d] %(message)s',
-                            level=logging.DEBUG,
-                            filename=self.params['log_file'])
+        self.configure_logging()
+        for message in warnings:
+            logging.warning(message)
 
         self.repo_dir = repo_dir
         logging.debug("In: '%s'", self.repo_dir)
 
-        self.conf = self.__load_conf_file(conf_file)
+        # No conf_file when serving: there is nothing to run
+        self.conf_file = conf_file
+        self.conf = self.__load_conf_file(conf_file) if conf_file else {}
 
         sys.path.append(self.params['hooks_dir'])
         self.hooks = self.load()
@@ -66,12 +226,60 @@ class Githooks(object):
                 defaults['conf_dir'] = os.path.join(root_dir, 'conf')
             if not 'hooks_dir' in defaults:
                 defaults['hooks_dir'] = os.path.join(root_dir, 'hooks.d')
+            # Hooks are imported when run, maybe from another cwd
+            defaults['hooks_dir'] = os.path.abspath(defaults['hooks_dir'])
+            if not 'jobs' in defaults:
+                defaults['jobs'] = '1'
+            if not 'cache_dir' in defaults:
+                defaults['cache_dir'] = defaults['conf_dir']
+            defaults['cache_dir'] = os.path.abspath(defaults['cache_dir'])
 
             self.params = defaults
 
         except ConfigParser.Error as err:
             raise RuntimeError("Could not load default settings from .ini: %s" % str(err))
 
+    def configure_logging(self):
+        '''
+        Set up logging to log_file as configured in githooks .ini:
+        log_level, log_max_bytes and log_backup_count for rotation,
+        log_async to write the log from a background thread.
+        '''
+        params = self.params
+
+        level = getattr(logging, params.get('log_level', 'DEBUG').upper(), None)
+        if not isinstance(level, int):
+            raise RuntimeError("Invalid 'log_level' setting: '%s'" % params['log_level'])
+
+        root = logging.getLogger()
+        root.setLevel(level)
+
+        # Configure the handlers once per process
+        if root.handlers:
+            return
+
+        try:
+            max_bytes = int(params.get('log_max_bytes', 0))
+            backup_count = int(params.get('log_backup_count', 5))
+        except ValueError as err:
+            raise RuntimeError("Invalid log rotation setting: %s" % str(err))
+
+        if max_bytes:
+            # logging.handlers takes long to import, only do it when rotating
+            from logging.handlers import RotatingFileHandler
+            handler = RotatingFileHandler(params['log_file'], maxBytes=max_bytes, backupCount=backup_count)
+        else:
+            handler = logging.FileHandler(params['log_file'])
+
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(filename)s:%(lineno)d %(process)d] %(message)s'))
+
+        if params.get('log_async', 'no').lower() in ('1', 'yes', 'true', 'on'):
+            handler = QueueHandler(handler)
+            atexit.register(handler.close)
+
+        root.addHandler(handler)
+
     def __load_conf_file(self, conf_file):
         '''
         Load githooks configuration from conf_dir/conf_file.
@@ -81,18 +289,18 @@ class Githooks(object):
 
         conf_path = os.path.join(conf_dir, conf_file)
         try:
-            with open(conf_path) as f:
-                conf = yaml.load(f.read())
+            conf = load_cached(conf_path, parse_conf_file)
             logging.debug("Loaded: '%s'", conf_path)
-        except IOError as err:
+        except (IOError, OSError) as err:
             logging.error(str(err))
             raise RuntimeError(str(err))
 
         return conf
 
-    def __load_ini_file(self, ini_file):
+    def __load_ini_file(self, ini_file, warnings):
         '''
         Load githooks .ini configuration from this_file_path/ini_file.
+        Add the warnings to log to 'warnings'.
         '''
         ini_dir = self.this_file_path
 
@@ -105,11 +313,18 @@ class Githooks(object):
 
         ini_path = os.path.join(ini_dir, ini_file)
         try:
-            with open(ini_path) as f:
-                ini.readfp(f)
-        except IOError as err:
+            defaults, sections = load_cached(ini_path, parse_ini_file, warnings)
+        except (IOError, OSError) as err:
             raise RuntimeError(str(err))
 
+        # Interpolate the cached options with this environment. Set
+        # them raw, so that bad values fail in ini.items(section) only
+        ini.defaults().update(defaults)
+        for section, options in sections.items():
+            ini.add_section(section)
+            for option, value in options:
+                ConfigParser.RawConfigParser.set(ini, section, option, value)
+
         return ini
 
     def load(self):
@@ -133,43 +348,349 @@ class Githooks(object):
                 logging.error(str(err))
                 pass
 
-            # Load the hooks from hooks_dir
+            # Import the hooks from hooks_dir when they are run
+            hooks.append(LazyHook(hook, repo_dir, conf[hook], hook_params))
+
+        return hooks
+
+    def preload(self):
+        '''
+        Import hookutil and all the hooks from hooks_dir.
+        '''
+        import hookutil
+
+        hooks_dir = self.params['hooks_dir']
+        for filename in sorted(os.listdir(hooks_dir)):
+            hook, ext = os.path.splitext(filename)
+            if ext != '.py':
+                continue
             try:
                 module = __import__(hook)
-                hooks.append(module.Hook(repo_dir, conf[hook], hook_params))
+                if hasattr(module, 'preload'):
+                    module.preload()
+                logging.debug("Preloaded: '%s'", hook)
             except ImportError as err:
-                message = "Could not load hook: '%s' (%s)" % (hook, str(err))
-                logging.error(message)
-                raise RuntimeError(message)
-
-        return hooks
+                logging.warning("Could not preload hook: '%s' (%s)", hook, str(err))
 
     def run(self, stdin):
         '''
         Run the hooks as specified in the given configuration file.
         Report messages and status.
+
+        Hooks are run for each ref in a pool of 'jobs' threads;
+        messages are reported in ref and hook order regardless.
         '''
+        import hookutil
+
         hooks = self.hooks
 
-        permit = True
+        try:
+            jobs = int(self.params['jobs'])
+        except ValueError as err:
+            raise RuntimeError("Invalid 'jobs' setting: %s" % str(err))
 
         # Read in each ref that the user is trying to update
-        for line in fileinput.input(stdin):
-            old_sha, new_sha, branch = line.strip().split(' ')
+        refs = [line.strip().split(' ') for line in fileinput.input(stdin)]
+
+        tasks = [(ref, hook) for ref in refs for hook in hooks]
+        timings = [None] * len(tasks)
+        parallel = jobs > 1 and len(tasks) > 1
+
+        profile = None
+        if self.params.get('profile_dir'):
+            import cProfile
+            import pstats
+            profile = cProfile.Profile()
 
-            for hook in hooks:
-                status, messages = hook.check(branch, old_sha, new_sha)
+        # cProfile only profiles the thread that enables it, so checks
+        # run in the pool are profiled each on its own
+        profiles = [None] * len(tasks) if profile and parallel else None
 
-                for message in messages:
-                    print "[%s @ %s]: %s" % (branch, message['at'][:7], message['text'])
+        def check(i):
+            (old_sha, new_sha, branch), hook = tasks[i]
 
-                permit = permit and status
+            start, cpu = time.time(), os.times()
+            if profiles:
+                profiles[i] = cProfile.Profile()
+                result = profiles[i].runcall(hook.check, branch, old_sha, new_sha)
+            else:
+                result = hook.check(branch, old_sha, new_sha)
+            end_cpu = os.times()
+
+            # CPU time is per process, so it can not be told apart
+            # between checks run concurrently
+            if parallel:
+                timings[i] = (time.time() - start, None)
+            else:
+                timings[i] = (time.time() - start, end_cpu[0] - cpu[0] + end_cpu[1] - cpu[1])
+
+            return result
+
+        hookutil.reset_stats()
+        start, cpu = time.time(), os.times()
+
+        try:
+            if profile:
+                profile.enable()
+
+            # Parse all pushed commits at once, once a hook shows one
+            hookutil.load_push(self.repo_dir, refs)
+
+            # Register the content checks of all hooks before any is
+            # run, so that each blob is read once, see hookutil.scan_blobs
+            if tasks:
+                for hook in hooks:
+                    register_scan = getattr(hook, 'register_scan', None)
+                    if register_scan:
+                        register_scan()
+
+            if parallel:
+                # Only import multiprocessing when it is used
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(min(jobs, len(tasks)))
+                try:
+                    results = pool.map(check, range(len(tasks)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [check(i) for i in range(len(tasks))]
+
+            # Remember the commits the hooks passed if the push goes in
+            if all(status for status, _ in results):
+                hookutil.accept_push()
+
+            # Send the mails the hooks queued, one per recipient
+            hookutil.flush_mail()
+        finally:
+            if profile:
+                profile.disable()
+                profile = pstats.Stats(profile)
+                for task_profile in profiles or []:
+                    if task_profile:
+                        profile.add(task_profile)
+
+            stats = hookutil.get_stats()
+
+            # Stop the git processes shared by the hooks
+            hookutil.cleanup()
+
+        permit = True
+
+        for ((old_sha, new_sha, branch), hook), (status, messages) in zip(tasks, results):
+            for message in messages:
+                print "[%s @ %s]: %s" % (branch, message['at'][:7], message['text'])
+
+            permit = permit and status
+
+        end_cpu = os.times()
+        stats.update({
+            'time': start,
+            'repo': self.repo_dir,
+            'conf': self.conf_file,
+            'jobs': jobs,
+            'permit': permit,
+            'wall': time.time() - start,
+            'cpu': end_cpu[0] - cpu[0] + end_cpu[1] - cpu[1],
+            'children_cpu': end_cpu[2] - cpu[2] + end_cpu[3] - cpu[3],
+            'checks': [],
+            'hooks': {},
+            'refs': {}
+        })
+        for ((old_sha, new_sha, branch), hook), (status, messages), (wall, cpu) in zip(tasks, results, timings):
+            name = hook.name
+            stats['checks'].append({'ref': branch, 'hook': name, 'status': status, 'wall': wall, 'cpu': cpu})
+            for key, total in ((name, stats['hooks']), (branch, stats['refs'])):
+                total.setdefault(key, {'wall': 0.0, 'cpu': None if parallel else 0.0})
+                total[key]['wall'] += wall
+                if not parallel:
+                    total[key]['cpu'] += cpu
+
+        self.__report_stats(stats, profile)
 
         if not permit:
             sys.exit(1)
 
         sys.exit(0)
 
+    def __report_stats(self, stats, profile):
+        '''
+        Write run statistics as a JSON line to stats_file (or the log)
+        and the profile to profile_dir.
+        '''
+        line = json.dumps(stats, sort_keys=True)
+
+        stats_file = self.params.get('stats_file')
+        if stats_file:
+            try:
+                with open(stats_file, 'a') as f:
+                    f.write(line + '\n')
+            except IOError as err:
+                logging.error("Could not write stats: %s", err)
+        else:
+            logging.info("Stats: %s", line)
+
+        if profile:
+            profile_path = os.path.join(self.params['profile_dir'],
+                                        'githooks-%d-%d.prof' % (stats['time'] * 1000, os.getpid()))
+            try:
+                profile.dump_stats(profile_path)
+            except IOError as err:
+                logging.error("Could not write profile: %s", err)
+
+
+# Environment of the push taken from githooks_client.py requests: what
+# git needs for the push and what githooks .ini interpolates. The rest,
+# e.g. PATH and git configuration, is the server's
+PUSH_ENV = ('GIT_DIR', 'GIT_OBJECT_DIRECTORY', 'GIT_ALTERNATE_OBJECT_DIRECTORIES',
+            'GIT_QUARANTINE_PATH', 'USER')
+PUSH_ENV_PREFIXES = ('GIT_PUSH_OPTION_', 'STASH_', 'BITBUCKET_', 'PULL_REQUEST_')
+
+
+def is_push_env(key):
+    '''
+    Check if environment variable 'key' is taken from the push.
+    '''
+    return key in PUSH_ENV or key.startswith(PUSH_ENV_PREFIXES)
+
+
+def handle_request(rfile, wfile, ini_file):
+    '''
+    Run githooks for a githooks_client.py request read from 'rfile'
+    in a forked child and write the response to 'wfile'.
+
+    The request is a JSON object with the client's 'argv', 'cwd',
+    'env' and 'stdin'; the response has 'output', 'error' and the
+    exit 'status'. Strings are passed as latin-1 to keep the bytes.
+    '''
+    import StringIO
+    import traceback
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler):
+            handler.after_fork()
+
+    status, output, error = 1, '', ''
+    try:
+        request = json.loads(rfile.read(), encoding='latin-1')
+
+        # git needs the environment of the push, e.g. the
+        # quarantine object directory, see PUSH_ENV
+        for key in os.environ.keys():
+            if is_push_env(key):
+                del os.environ[key]
+        for key, value in request['env'].items():
+            key = key.encode('latin-1')
+            if is_push_env(key):
+                os.environ[key] = value.encode('latin-1')
+
+        # Relative paths in githooks .ini are resolved against
+        # the server's cwd, as if it ran githooks.py
+        argv = [arg.encode('latin-1') for arg in request['argv']]
+        cwd = request['cwd'].encode('latin-1')
+        githooks = Githooks(conf_file=argv[0], ini_file=ini_file, repo_dir=cwd)
+        os.chdir(cwd)
+
+        sys.stdin = StringIO.StringIO(request['stdin'].encode('latin-1'))
+        sys.stdout = StringIO.StringIO()
+        try:
+            githooks.run(argv[1:])
+        except SystemExit as err:
+            status = err.code or 0
+        output = sys.stdout.getvalue()
+    except Exception:
+        error = traceback.format_exc()
+        logging.error(error)
+    finally:
+        sys.stdout = sys.__stdout__
+
+    if isinstance(output, unicode):
+        output = output.encode('utf-8')
+
+    wfile.write(json.dumps({'status': status, 'output': output, 'error': error},
+                           encoding='latin-1'))
+
+    # The child leaves with os._exit(), write out the log first
+    logging.shutdown()
+
+
+def verify_client(sock):
+    '''
+    Check that the client connected to UNIX socket 'sock' is run
+    by the server's user.
+    '''
+    import socket
+    import struct
+
+    # Not in the socket module of python 2, Linux value
+    so_peercred = getattr(socket, 'SO_PEERCRED', 17)
+    try:
+        creds = sock.getsockopt(socket.SOL_SOCKET, so_peercred, struct.calcsize('3i'))
+    except socket.error as err:
+        # No SO_PEERCRED, rely on the socket mode
+        logging.debug("Could not get client credentials: %s", err)
+        return True
+
+    pid, uid, gid = struct.unpack('3i', creds)
+    if uid != os.getuid():
+        logging.warning("Rejected a request from uid %d (pid %d)", uid, pid)
+        return False
+
+    return True
+
+
+def serve(socket_path, ini_file):
+    '''
+    Serve githooks_client.py requests on UNIX socket 'socket_path'
+    until terminated.
+
+    A githooks run is forked per request from a process that has the
+    hooks imported already, see handle_request. Nothing else is kept
+    between requests: the caches of a run go with its child.
+
+    Only the server's user may connect: the socket is created with
+    mode 0600 and the credentials of each client are checked.
+    '''
+    # Only the server needs these, do not import them on each push
+    import SocketServer
+
+    class RequestHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            handle_request(self.rfile, self.wfile, ini_file)
+
+    class Server(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+        def verify_request(self, request, client_address):
+            return verify_client(request)
+
+    Githooks(conf_file=None, ini_file=ini_file).preload()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    umask = os.umask(0177)
+    try:
+        server = Server(socket_path, RequestHandler)
+    finally:
+        os.umask(umask)
+
+    def terminate(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    logging.info("Serving on '%s'", socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
 
 if __name__ == '__main__':
-    Githooks(conf_file=sys.argv[1], ini_file='githooks.ini').run(sys.argv[2:])
+    if sys.argv[1:2] == ['--serve']:
+        # githooks.py --serve [socket [ini_file]]
+        args = sys.argv[2:] + [None, None]
+        serve(socket_path=args[0] or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'githooks.sock'),
+              ini_file=args[1] or 'githooks.ini')
+    else:
+        Githooks(conf_file=sys.argv[1], ini_file='githooks.ini').run(sys.argv[2:])
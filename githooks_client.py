@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+#
+# ==================================================================
+#
+# Copyright (c) 2016, Parallels IP Holdings GmbH
+# Released under the terms of MIT license (see LICENSE for details)
+#
+# ==================================================================
+#
+'''
+Stash external hooks entry point for a githooks server
+
+Passes the arguments, stdin, environment and cwd to a server started
+with `githooks.py --serve` and reports its messages and status. Runs
+githooks.py itself if the server is not there.
+
+The server socket is $GITHOOKS_SOCKET or githooks.sock next to this
+file.
+'''
+
+import os
+import sys
+import socket
+import json
+
+
+def main(argv):
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    socket_path = os.environ.get('GITHOOKS_SOCKET', os.path.join(root_dir, 'githooks.sock'))
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        # No server, stdin is not read yet
+        githooks = os.path.join(root_dir, 'githooks.py')
+        os.execv(sys.executable, [sys.executable, githooks] + argv)
+
+    # Pass bytes as latin-1, see githooks.handle_request
+    request = {
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+        'stdin': sys.stdin.read() if len(argv) < 2 else ''
+    }
+    sock.sendall(json.dumps(request, encoding='latin-1'))
+    sock.shutdown(socket.SHUT_WR)
+
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    sock.close()
+
+    response = json.loads(''.join(chunks))
+    sys.stdout.write(response['output'].encode('latin-1'))
+    sys.stderr.write(response['error'].encode('latin-1'))
+
+    return response['status']
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
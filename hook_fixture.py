@@ -4,30 +4,28 @@ import os
 import sys
 import socket
 import json
-import time
 
 data = json.dumps(sys.argv[1:])
 
-request = os.path.join(os.getcwd(), '..', 'request.json')
-response = os.path.join(os.getcwd(), '..', 'response.json')
+# The test listens in its workspace, next to the remote repo
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+sock.settimeout(20)
+sock.connect(os.path.join(os.getcwd(), '..', 'hook.sock'))
+sock.sendall(data)
+sock.shutdown(socket.SHUT_WR)
 
-with open(request, 'w+') as req:
-    req.write(data)
-
-attempts = 0
+chunks = []
 while 1:
-    if not os.path.exists(response):
-        attempts = attempts + 1
-        time.sleep(0.1)
-    else:
+    chunk = sock.recv(65536)
+    if not chunk:
         break
+    chunks.append(chunk)
+sock.close()
 
-    if attempts >= 200:
-        raise RuntimeError('Timeout exceeded')
+if not chunks:
+    raise RuntimeError('No response')
 
-with open(response) as f:
-    data = json.loads(f.read())
-os.remove(response)
+data = json.loads(''.join(chunks))
 
 code = data[0]
 text = data[1]
@@ -19,6 +19,46 @@ import logging
 import hookutil
 
 
+def compile_copyrights(copyrights):
+    '''
+    Compile (start, full) copyright patterns. Return the list of
+    compiled pairs and a single pattern matching any of the starts,
+    or None if the starts can not be combined.
+    '''
+    try:
+        patterns = [(re.compile(start), re.compile(full)) for (start, full) in copyrights]
+    except re.error as err:
+        raise RuntimeError("Invalid copyright pattern: %s" % str(err))
+
+    # Flags, backreferences and named groups would change meaning
+    # in an alternation or clash there
+    starts = [start for (start, full) in patterns]
+    if len(starts) < 2 or any(start.flags or re.search(r'\\[1-9]|\(\?P[=<]', start.pattern) for start in starts):
+        return patterns, None
+
+    try:
+        any_start = re.compile('|'.join('(?:%s)' % start.pattern for start in starts))
+    except re.error:
+        any_start = None
+
+    return patterns, any_start
+
+
+def has_good_copyright(file_contents, patterns, any_start=None):
+    '''
+    Check if file contains good copyright string
+    '''
+    # Most files have none of the copyrights at all
+    if any_start is not None and not any_start.search(file_contents):
+        return True
+
+    for (start, full) in patterns:
+        if start.search(file_contents):
+            if not full.search(file_contents):
+                return False
+    return True
+
+
 class Hook(object):
 
     def __init__(self, repo_dir, settings, params):
@@ -26,6 +66,51 @@ class Hook(object):
         # Replace '%Y' in copyright string with current year
         self.settings = [(copyright['start'].replace('%Y', str(datetime.date.today().year)), copyright['full'].replace('%Y', str(datetime.date.today().year))) for copyright in settings]
         self.params = params
+        self.patterns, self.any_start = compile_copyrights(self.settings)
+
+        # Look for copyrights in the first header_bytes and
+        # header_lines of each file only (0 for whole files)
+        try:
+            self.header_bytes = int(params.get('header_bytes', 0))
+            self.header_lines = int(params.get('header_lines', 0))
+        except ValueError as err:
+            raise RuntimeError("Invalid header window setting: %s" % str(err))
+
+        # Check the files modified by each commit, or their contents at new_sha only
+        self.mode = params.get('mode', 'commits')
+        if self.mode not in ('commits', 'tip'):
+            raise RuntimeError("Invalid 'mode' setting: '%s'" % self.mode)
+
+        self.cache_key = hookutil.settings_key(__name__, [self.settings, self.header_bytes, self.header_lines])
+
+    def scan_header(self):
+        '''
+        Check the copyrights in the first header_lines of a file, see
+        hookutil.scan_blob. Yields the verdict at the end of the header.
+        '''
+        header = []
+        lines = 0
+        chunk = yield
+        while chunk is not None:
+            if self.header_lines and lines + chunk.count('\n') >= self.header_lines:
+                end = -1
+                for _ in range(self.header_lines - lines):
+                    end = chunk.find('\n', end + 1)
+                header.append(chunk[:end + 1])
+                break
+
+            lines += chunk.count('\n')
+            header.append(chunk)
+            chunk = yield
+
+        yield has_good_copyright(''.join(header), self.patterns, self.any_start)
+
+    def register_scan(self):
+        '''
+        Register the content check for the push, see hookutil.register_scan.
+        '''
+        if self.settings:
+            hookutil.register_scan(self.cache_key, self.scan_header, self.header_bytes)
 
     def check(self, branch, old_sha, new_sha):
         logging.debug("Run: branch=%s, old_sha=%s, new_sha=%s",
@@ -45,21 +130,40 @@ class Hook(object):
         # Before the hook is run git has already created
         # a new_sha commit object
 
-        log = hookutil.parse_git_log(self.repo_dir, branch, old_sha, new_sha, this_branch_only=False)
+        # Verdicts on blobs and commits checked before
+        cache = hookutil.get_verdict_cache(self.params)
+
+        commits = []
+        if self.mode == 'tip':
+            # Errors are reported at new_sha
+            modfiles = hookutil.parse_git_tip(self.repo_dir, branch, old_sha, new_sha, this_branch_only=False)
+            commits.append((new_sha, modfiles))
+        else:
+            log = hookutil.parse_git_log(self.repo_dir, branch, old_sha, new_sha, this_branch_only=False)
+            for commit in log:
+                if cache and cache.is_validated(self.cache_key, commit['commit']):
+                    logging.debug("Commit %s passed before, skip", commit['commit'])
+                    continue
+
+                modfiles = hookutil.parse_git_show(self.repo_dir, commit['commit'])
+                commits.append((commit['commit'], modfiles))
+
+        # Scan the files with no verdicts yet at once
+        verdicts = {}
+        for sha, modfiles in commits:
+            for modfile in modfiles:
+                if modfile['status'] != 'D':
+                    verdicts[modfile['new_blob']] = cache.get(self.cache_key, modfile['new_blob']) if cache else None
+        blobs = [blob for blob, verdict in verdicts.items() if verdict is None]
+        scanned = hookutil.scan_blobs(self.repo_dir, self.cache_key, self.scan_header, blobs, self.header_bytes)
+        for blob, permit_file in scanned.items():
+            verdicts[blob] = permit_file
+            if cache:
+                cache.put(self.cache_key, blob, permit_file)
 
         messages = []
-        for commit in log:
-            modfiles = hookutil.parse_git_show(self.repo_dir, commit['commit'])
-
-            def has_good_copyright(file_contents, copyrights):
-                '''
-                Check if file contains good copyright string
-                '''
-                for (start, full) in copyrights:
-                    if re.search(start, file_contents):
-                        if not re.search(full, file_contents):
-                            return False
-                return True
+        for sha, modfiles in commits:
+            permit_commit = True
 
             for modfile in modfiles:
                 # Skip deleted files
@@ -67,16 +171,18 @@ class Hook(object):
                     logging.debug("Deleted %s, skip", modfile['path'])
                     continue
 
-                cmd = ['git', 'show', modfile['new_blob']]
-                _, file_contents, _ = hookutil.run(cmd, self.repo_dir)
+                permit_file = verdicts[modfile['new_blob']]
 
-                permit_file = has_good_copyright(file_contents, self.settings)
                 logging.debug("modfile='%s', permit_file='%s'", modfile['path'], permit_file)
 
                 if not permit_file:
-                    messages.append({'at': commit['commit'],
+                    messages.append({'at': sha,
                         'text': "Error: Bad copyright in file '%s'!" % modfile['path']})
-                permit = permit and permit_file
+                permit_commit = permit_commit and permit_file
+
+            if self.mode == 'commits' and permit_commit and cache:
+                cache.validate(self.cache_key, sha)
+            permit = permit and permit_commit
 
         if not permit:
             text = 'Please update the copyright strings to match one of the following:\n\n\t- ' + '\n\t- '.join([full for (start, full) in self.settings])
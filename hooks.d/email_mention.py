@@ -100,7 +100,8 @@ class Hook(object):
         mails = self.compose_mail(branch, old_sha, new_sha)
         hookutil.send_mail(mails, smtp_from,
             "%s/%s - Hook email-mention: You were mentioned in a commit message" % (proj_key, repo_name),
-            smtp_server, smtp_port)
+            smtp_server, smtp_port,
+            self.params.get('mail_spool_dir'), self.params.get('mail_digest_window'))
 
         return True, []
 
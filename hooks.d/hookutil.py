@@ -15,75 +15,166 @@ hookutil: Hook utilities
 
 import subprocess
 import tempfile
+import sys
 import os
 import re
 import logging
+import threading
+import time
+import json
+import hashlib
+import sqlite3
 
-import smtplib
-from email.MIMEMultipart import MIMEMultipart
-from email.MIMEText import MIMEText
-from email.Utils import formatdate, make_msgid
 
+_stats = {'processes': 0, 'time': 0.0, 'bytes': 0}
+_stats_lock = threading.Lock()
 
-def run(cmd, exec_dir=os.getcwd(), env=None, check_ret=True):
+# All Memoized functions, see get_stats
+_memoized = []
+
+
+def count_process(processes, elapsed, nbytes):
     '''
-    Execute a command in 'exec_dir' directory.
+    Account for subprocesses spawned, time spent waiting for them
+    and bytes read from them.
     '''
-    log_cmd = ' '.join(cmd[:10] + [" ... (cut %s)" % (len(cmd)-10)] if len(cmd) > 10 else cmd)
+    with _stats_lock:
+        _stats['processes'] += processes
+        _stats['time'] += elapsed
+        _stats['bytes'] += nbytes
+
+
+def get_stats():
+    '''
+    Get subprocess and cache statistics collected since reset_stats:
+        {
+            'git': {'processes': count, 'time': seconds, 'bytes': count},
+            'caches': {name: {'hits': count, 'misses': count}, ...}
+        }
+    '''
+    with _stats_lock:
+        stats = {'git': dict(_stats), 'caches': {}}
 
-    with tempfile.TemporaryFile() as out_fd:
-        with tempfile.TemporaryFile() as err_fd:
+    for memoized in _memoized:
+        stats['caches'][memoized.function.__name__] = {'hits': memoized.hits, 'misses': memoized.misses}
 
-            proc = subprocess.Popen(cmd,
-                                    stdout=out_fd,
-                                    stderr=err_fd,
-                                    cwd=exec_dir,
-                                    env=env)
-            ret = proc.wait()
+    with _verdict_caches_lock:
+        caches = _verdict_caches.values()
+    if caches:
+        stats['caches']['verdicts'] = {'hits': sum(cache.hits for cache in caches),
+                                       'misses': sum(cache.misses for cache in caches)}
+        stats['caches']['validated'] = {'hits': sum(cache.validated_hits for cache in caches),
+                                        'misses': sum(cache.validated_misses for cache in caches)}
 
-            out_fd.seek(0)
-            out = out_fd.read()
+    return stats
 
-            err_fd.seek(0)
-            err = err_fd.read()
 
-            if check_ret and ret != 0:
-                logging.error("Command '%s' returned non-zero exit status %s (%s)",
-                              log_cmd, ret, err)
-                raise subprocess.CalledProcessError(ret, log_cmd)
+def reset_stats():
+    '''
+    Reset the statistics returned by get_stats.
+    '''
+    with _stats_lock:
+        _stats.update({'processes': 0, 'time': 0.0, 'bytes': 0})
 
-            return ret, out, err
+    for memoized in _memoized:
+        memoized.hits = memoized.misses = 0
 
 
-def get_attr(repo_dir, new_sha, filename, attr):
+def run(cmd, exec_dir=None, env=None, check_ret=True, input=None):
     '''
-    Get git attribute 'attr' of file 'filename'.
+    Execute a command in 'exec_dir' directory.
 
-    - repo_dir: repository root
-    - new_sha: git object hash
+    - input: data to pass to the command's stdin
     '''
-    idx_file = tempfile.mkstemp(suffix='git_index')[1]
+    log_cmd = ' '.join(cmd[:10] + [" ... (cut %s)" % (len(cmd)-10)] if len(cmd) > 10 else cmd)
 
-    env = os.environ.copy()
-    env['GIT_INDEX_FILE'] = idx_file
+    start = time.time()
+    proc = subprocess.Popen(cmd,
+                            stdin=subprocess.PIPE if input is not None else None,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            cwd=exec_dir,
+                            env=env)
+    out, err = proc.communicate(input)
+    ret = proc.returncode
+    count_process(1, time.time() - start, len(out))
+
+    if check_ret and ret != 0:
+        logging.error("Command '%s' returned non-zero exit status %s (%s)",
+                      log_cmd, ret, err)
+        raise subprocess.CalledProcessError(ret, log_cmd)
+
+    return ret, out, err
+
+
+def iter_run(cmd, exec_dir=None, env=None, check_ret=True, input=None, sep='\n', bufsize=65536):
+    '''
+    Execute a command in 'exec_dir' directory. Iterate over its output
+    records separated by 'sep' as they are read from the pipe, so that
+    the whole output is never kept in memory. stderr is collected
+    separately. Non-zero exit status is checked once all the output
+    is read.
+
+    - input: data to pass to the command's stdin
+    '''
+    log_cmd = ' '.join(cmd[:10] + [" ... (cut %s)" % (len(cmd)-10)] if len(cmd) > 10 else cmd)
 
-    # Create an index from new_sha.
-    cmd = ['git', 'read-tree', new_sha]
-    run(cmd, repo_dir, env)
+    start = time.time()
+    nbytes = 0
+    proc = subprocess.Popen(cmd,
+                            stdin=subprocess.PIPE if input is not None else None,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            cwd=exec_dir,
+                            env=env)
 
-    # Get the attr only from the index.
-    cmd = ['git', 'check-attr', '--cached', attr, '--', filename]
-    _, out, _ = run(cmd, repo_dir, env)
+    # Feed stdin and drain stderr in threads, so that neither
+    # of the pipes blocks the command while stdout is read.
+    err = []
+    def drain():
+        err.append(proc.stderr.read())
 
-    os.remove(idx_file)
+    def feed():
+        try:
+            proc.stdin.write(input)
+        except IOError:
+            # The command exited without reading all the input
+            pass
+        finally:
+            proc.stdin.close()
+
+    threads = [threading.Thread(target=drain)]
+    if input is not None:
+        threads.append(threading.Thread(target=feed))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
-    # Parse 'git check-attr' output.
-    chunks = [c.strip() for c in out.split(':')]
-    assert chunks[0] == filename
-    assert chunks[1] == attr
-    logging.debug("filename=%s, git attr %s=%s", filename, attr, chunks[2])
+    try:
+        tail = ''
+        while True:
+            chunk = os.read(proc.stdout.fileno(), bufsize)
+            if not chunk:
+                break
+            nbytes += len(chunk)
+            records = (tail + chunk).split(sep)
+            tail = records.pop()
+            for record in records:
+                yield record
+        if tail:
+            yield tail
+    finally:
+        proc.stdout.close()
+        ret = proc.wait()
+        for thread in threads:
+            thread.join()
+        proc.stderr.close()
+        count_process(1, time.time() - start, nbytes)
 
-    return chunks[2]
+    if check_ret and ret != 0:
+        logging.error("Command '%s' returned non-zero exit status %s (%s)",
+                      log_cmd, ret, ''.join(err))
+        raise subprocess.CalledProcessError(ret, log_cmd)
 
 
 class Memoized(object):
@@ -91,19 +182,878 @@ class Memoized(object):
     Decorator. Caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned
     (not reevaluated).
+
+    At most 'maxsize' values are kept, the least recently used ones are
+    evicted first. Values older than 'ttl' seconds are reevaluated.
+    Calls with unhashable arguments are not cached.
     '''
-    def __init__(self, function):
+    def __init__(self, function, maxsize=1024, ttl=None):
         self.function = function
+        self.maxsize = maxsize
+        self.ttl = ttl
         self.memoized = {}
+        self.lock = threading.Lock()
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        _memoized.append(self)
+
+    def __key(self, args, kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
     def __call__(self, *args, **kwargs):
-        key = args + tuple(kwargs.values())
+        key = self.__key(args, kwargs)
+
+        with self.lock:
+            self.tick += 1
+            entry = self.memoized.get(key) if key is not None else None
+            if entry is not None and (self.ttl is None or time.time() - entry[1] < self.ttl):
+                self.hits += 1
+                entry[2] = self.tick
+                return entry[0]
+            self.misses += 1
+
+        value = self.function(*args, **kwargs)
+        if key is not None:
+            self.prime(value, *args, **kwargs)
+
+        return value
+
+    def prime(self, value, *args, **kwargs):
+        '''
+        Cache 'value' as the return value for the given arguments.
+        '''
+        key = self.__key(args, kwargs)
+        with self.lock:
+            self.tick += 1
+            self.memoized[key] = [value, time.time(), self.tick]
+
+            if len(self.memoized) > self.maxsize:
+                # Evict the least recently used quarter at once
+                entries = sorted(self.memoized.items(), key=lambda entry: entry[1][2])
+                for evicted, _ in entries[:len(entries) - self.maxsize * 3 / 4]:
+                    del self.memoized[evicted]
+
+    def clear(self):
+        '''
+        Drop all cached values.
+        '''
+        with self.lock:
+            self.memoized.clear()
+
+
+def memoize(maxsize=1024, ttl=None):
+    '''
+    Decorator factory for Memoized with custom limits.
+    '''
+    return lambda function: Memoized(function, maxsize, ttl)
+
+
+_attr_indexes = {}
+_attr_indexes_lock = threading.Lock()
+
+
+def get_attr_index(repo_dir, new_sha):
+    '''
+    Get the path to an index file created from 'new_sha'.
+    The index is built once and reused until cleanup.
+    '''
+    with _attr_indexes_lock:
+        idx_file = _attr_indexes.get((repo_dir, new_sha))
+        if idx_file is not None:
+            return idx_file
+
+        fd, idx_file = tempfile.mkstemp(suffix='git_index')
+        os.close(fd)
+
+        env = os.environ.copy()
+        env['GIT_INDEX_FILE'] = idx_file
+
+        # Create an index from new_sha.
+        cmd = ['git', 'read-tree', new_sha]
         try:
-            logging.debug("Retreiving memoized %s %s %s", self.function, args, kwargs)
-            return self.memoized[key]
-        except KeyError:
-            logging.debug("Memoize %s %s %s", self.function, args, kwargs)
-            self.memoized[key] = self.function(*args, **kwargs)
-            return self.memoized[key]
+            run(cmd, repo_dir, env)
+        except subprocess.CalledProcessError:
+            os.remove(idx_file)
+            raise
+
+        _attr_indexes[(repo_dir, new_sha)] = idx_file
+        return idx_file
+
+
+def get_attrs(repo_dir, new_sha, paths, attrs):
+    '''
+    Get git attributes 'attrs' of files 'paths' at once. Return
+    a dictionary of dictionaries:
+        {
+            path: {attr: value, ...},
+            ...
+        }
+
+    - repo_dir: repository root
+    - new_sha: git object hash
+    '''
+    result = dict((path, {}) for path in paths)
+    if not result or not attrs:
+        return result
+
+    env = os.environ.copy()
+    env['GIT_INDEX_FILE'] = get_attr_index(repo_dir, new_sha)
+
+    # Get the attrs only from the index.
+    cmd = ['git', 'check-attr', '--cached', '--stdin', '-z'] + list(attrs)
+    out = iter_run(cmd, repo_dir, env, input='\0'.join(result) + '\0', sep='\0')
+
+    # Parse 'git check-attr -z' output: <path> NUL <attr> NUL <value> NUL
+    for path in out:
+        attr = next(out)
+        result[path][attr] = next(out)
+
+    return result
+
+
+@memoize(maxsize=65536)
+def get_attr(repo_dir, new_sha, filename, attr):
+    '''
+    Get git attribute 'attr' of file 'filename'.
+
+    - repo_dir: repository root
+    - new_sha: git object hash
+    '''
+    value = get_attrs(repo_dir, new_sha, [filename], [attr])[filename][attr]
+    logging.debug("filename=%s, git attr %s=%s", filename, attr, value)
+
+    return value
+
+
+def compile_pattern(pattern):
+    '''
+    Compile a .gitattributes pattern to a regular expression, with
+    wildmatch rules: '*' and '?' do not match '/', '**' does.
+    '''
+    i, n, res = 0, len(pattern), []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 2] == '**' and (i == 0 or pattern[i - 1] == '/') and pattern[i + 2:i + 3] in ('', '/'):
+                # '**/' matches any leading directories, '/**' anything inside
+                res.append('.*' if i + 2 == n else '(?:.*/)?')
+                i += 3
+                continue
+            while i < n and pattern[i] == '*':
+                i += 1
+            res.append('[^/]*')
+            continue
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if pattern[j:j + 1] in ('!', '^'):
+                j += 1
+            if pattern[j:j + 1] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+            else:
+                chars = pattern[i + 1:j]
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                res.append('[%s]' % chars)
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            res.append(re.escape(pattern[i]))
+        else:
+            res.append(re.escape(c))
+        i += 1
+
+    return re.compile('(?s)' + ''.join(res) + '\\Z')
+
+
+def parse_gitattributes(base, text):
+    '''
+    Parse .gitattributes 'text' from directory 'base' (relative to
+    the repository root, '' for the root) into a list of rules:
+        [
+            (base, match_basename, regex, {attr: value, ...}),
+            ...
+        ]
+
+    Values are those of 'git check-attr': 'set', 'unset',
+    'unspecified' or the value. Macros are not supported.
+    '''
+    rules = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or line.startswith('[attr]'):
+            continue
+
+        if line.startswith('"'):
+            end = line.find('"', 1)
+            while end > 0 and line[end - 1] == '\\':
+                end = line.find('"', end + 1)
+            if end < 0:
+                continue
+            pattern, attrs = line[1:end].decode('string_escape'), line[end + 1:].split()
+        else:
+            fields = line.split()
+            pattern, attrs = fields[0], fields[1:]
+
+        # Patterns for directories never match files
+        if pattern.endswith('/'):
+            continue
+
+        values = {}
+        for attr in attrs:
+            if attr.startswith('-'):
+                values[attr[1:]] = 'unset'
+            elif attr.startswith('!'):
+                values[attr[1:]] = 'unspecified'
+            elif '=' in attr:
+                name, value = attr.split('=', 1)
+                values[name] = value
+            else:
+                values[attr] = 'set'
+
+        # Patterns with no slash match file names at any depth
+        match_basename = '/' not in pattern
+        rules.append((base, match_basename, compile_pattern(pattern.lstrip('/')), values))
+
+    return rules
+
+
+@memoize(maxsize=4096)
+def get_gitattributes_rules(repo_dir, base, blob):
+    '''
+    Get the rules of .gitattributes 'blob' from directory 'base'.
+    Blobs never change, so the rules are not dropped on cleanup.
+    '''
+    return parse_gitattributes(base, get_blob(repo_dir, blob))
+
+
+def match_attr(repo_dir, new_sha, paths, attr):
+    '''
+    Get git attribute 'attr' of files 'paths' at 'new_sha' like
+    get_attrs does, but by matching the .gitattributes files of
+    new_sha in memory. Return a dictionary {path: value}.
+
+    Like 'git check-attr --cached', $GIT_DIR/info/attributes takes
+    precedence; core.attributesFile is not supported.
+    '''
+    def parent_dirs(path):
+        # Deepest first, '' for the root
+        parts = path.split('/')[:-1]
+        return ['/'.join(parts[:i]) for i in range(len(parts), -1, -1)]
+
+    paths = list(paths)
+    dirs = sorted(set(d for path in paths for d in parent_dirs(path)))
+    if not dirs:
+        return {}
+
+    # Find all .gitattributes blobs that may apply with one process
+    names = [d + '/.gitattributes' if d else '.gitattributes' for d in dirs]
+    cmd = ['git', 'cat-file', '--batch-check']
+    out = iter_run(cmd, repo_dir, input=''.join('%s:%s\n' % (new_sha, name) for name in names))
+
+    rules = {}
+    for d, line in zip(dirs, out):
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == 'blob':
+            rules[d] = get_gitattributes_rules(repo_dir, d, fields[0])
+
+    info = []
+    git_dir = os.path.join(repo_dir, '.git')
+    info_path = os.path.join(git_dir if os.path.isdir(git_dir) else repo_dir, 'info', 'attributes')
+    if os.path.isfile(info_path):
+        with open(info_path) as f:
+            info = parse_gitattributes('', f.read())
+
+    result = {}
+    for path in paths:
+        value = 'unspecified'
+
+        # Later lines and deeper files take precedence
+        for ruleset in [info] + [rules[d] for d in parent_dirs(path) if d in rules]:
+            for base, match_basename, regex, values in reversed(ruleset):
+                if attr not in values:
+                    continue
+                name = path[len(base) + 1:] if base else path
+                if match_basename:
+                    name = name.rsplit('/', 1)[-1]
+                if regex.match(name):
+                    value = values[attr]
+                    break
+            else:
+                continue
+            break
+
+        result[path] = value
+
+    return result
+
+
+class BlobReader(object):
+    '''
+    Read blob contents through a single long-lived 'git cat-file --batch'
+    process instead of running 'git show' for each blob.
+    '''
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def __start(self):
+        logging.debug("Starting 'git cat-file --batch' in '%s'", self.repo_dir)
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     cwd=self.repo_dir)
+        count_process(1, 0, 0)
+
+    def read(self, sha):
+        '''
+        Return the contents of blob 'sha'.
+        '''
+        with self.lock:
+            if self.proc is None:
+                self.__start()
+
+            start = time.time()
+            self.proc.stdin.write(sha + '\n')
+            self.proc.stdin.flush()
+
+            # Header: '<sha> <type> <size>' or '<sha> missing'
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:
+                raise RuntimeError("Could not read object '%s' (%s)" % (sha, ' '.join(header)))
+
+            size = int(header[2])
+            contents = self.proc.stdout.read(size)
+            # Each object is followed by a newline
+            self.proc.stdout.read(1)
+            count_process(0, time.time() - start, size)
+
+            return contents
+
+    def iter_read(self, sha, chunk_size=65536):
+        '''
+        Yield the contents of blob 'sha' in chunks of 'chunk_size'
+        bytes. The reader is busy until the generator is exhausted
+        or closed; the rest of the blob is skipped then.
+        '''
+        with self.lock:
+            if self.proc is None:
+                self.__start()
+
+            start = time.time()
+            self.proc.stdin.write(sha + '\n')
+            self.proc.stdin.flush()
+
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:
+                raise RuntimeError("Could not read object '%s' (%s)" % (sha, ' '.join(header)))
+
+            size = left = int(header[2])
+            try:
+                while left > 0:
+                    chunk = self.proc.stdout.read(min(chunk_size, left))
+                    if not chunk:
+                        raise RuntimeError("Could not read object '%s' (unexpected EOF)" % sha)
+                    left -= len(chunk)
+                    yield chunk
+            finally:
+                if left > BLOB_DRAIN_LIMIT:
+                    # Cheaper to restart 'git cat-file' than to read it all
+                    self.__stop(kill=True)
+                else:
+                    while left > 0:
+                        chunk = self.proc.stdout.read(min(chunk_size, left))
+                        if not chunk:
+                            break
+                        left -= len(chunk)
+                    # Each object is followed by a newline
+                    self.proc.stdout.read(1)
+                # Bytes skipped by killing 'git cat-file' are not read
+                count_process(0, time.time() - start, size - left)
+
+    def __stop(self, kill=False):
+        if kill:
+            self.proc.kill()
+        else:
+            self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+
+    def close(self):
+        '''
+        Terminate the 'git cat-file' process.
+        '''
+        with self.lock:
+            if self.proc is None:
+                return
+            self.__stop()
+
+
+_blob_readers = {}
+_blob_readers_lock = threading.Lock()
+
+# Skip up to that many bytes of a blob left unread, restart
+# 'git cat-file' if more
+BLOB_DRAIN_LIMIT = 1 << 20
+
+
+def get_blob_reader(repo_dir):
+    with _blob_readers_lock:
+        reader = _blob_readers.get(repo_dir)
+        if reader is None:
+            reader = _blob_readers[repo_dir] = BlobReader(repo_dir)
+
+    return reader
+
+
+def get_blob(repo_dir, sha):
+    '''
+    Get the contents of blob 'sha' from the repository 'repo_dir'.
+    Blobs are read by a BlobReader shared by all hooks, see cleanup.
+    '''
+    return get_blob_reader(repo_dir).read(sha)
+
+
+def iter_blob(repo_dir, sha, chunk_size=65536):
+    '''
+    Iterate over the contents of blob 'sha' in chunks, see
+    BlobReader.iter_read. Close the iterator when done with it.
+    '''
+    return get_blob_reader(repo_dir).iter_read(sha, chunk_size)
+
+
+def read_blob(repo_dir, sha, max_bytes=0):
+    '''
+    Get the first 'max_bytes' bytes of blob 'sha', or all of it
+    if 'max_bytes' is 0. The rest of the blob is not read.
+    '''
+    if not max_bytes:
+        return get_blob(repo_dir, sha)
+
+    chunks = iter_blob(repo_dir, sha)
+    try:
+        data = []
+        size = 0
+        for chunk in chunks:
+            data.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                break
+    finally:
+        chunks.close()
+
+    return ''.join(data)[:max_bytes]
+
+
+def feed_scanner(scanner, chunks):
+    '''
+    Send 'chunks' to content check 'scanner', see scan_blob, until
+    it has a verdict. Return the verdict.
+    '''
+    next(scanner)
+    try:
+        for chunk in chunks:
+            verdict = scanner.send(chunk)
+            if verdict is not None:
+                return verdict
+        return scanner.send(None)
+    finally:
+        scanner.close()
+
+
+# Content checks of the hooks run on a push, the checks under way
+# on each blob and their verdicts, see scan_blobs
+_scans = {}
+_scan_reading = {}
+_scan_results = {}
+_scans_lock = threading.Lock()
+_scans_done = threading.Condition(_scans_lock)
+
+
+def scan_blob(repo_dir, blob, scans):
+    '''
+    Run content checks 'scans', an array of (key, scanner, max_bytes)
+    tuples, on a single read of 'blob'. Return a dictionary {key: verdict}.
+
+    'scanner' is a generator function. The generator it returns is sent
+    the chunks of the blob as they are read, cut to 'max_bytes' bytes
+    in total if it is not 0, and then None at the end. It yields None
+    until it has a verdict, which must not be None. The blob is read
+    only as far as the checks go, and no chunk is kept once sent.
+    '''
+    checks = []
+    for key, scanner, max_bytes in scans:
+        generator = scanner()
+        next(generator)
+        checks.append([key, generator, max_bytes])
+
+    verdicts = {}
+    chunks = iter_blob(repo_dir, blob)
+    try:
+        for chunk in chunks:
+            for check in checks[:]:
+                key, generator, max_bytes = check
+                if max_bytes:
+                    chunk_bytes = chunk[:max_bytes]
+                    verdict = generator.send(chunk_bytes)
+                    check[2] = max_bytes = max_bytes - len(chunk_bytes)
+                    if verdict is None and not max_bytes:
+                        verdict = generator.send(None)
+                else:
+                    verdict = generator.send(chunk)
+
+                if verdict is not None:
+                    verdicts[key] = verdict
+                    generator.close()
+                    checks.remove(check)
+
+            if not checks:
+                break
+    finally:
+        chunks.close()
+
+    for key, generator, _ in checks:
+        verdicts[key] = generator.send(None)
+        generator.close()
+
+    return verdicts
+
+
+def register_scan(key, scanner, max_bytes=0):
+    '''
+    Register content check 'scanner' under 'key', usually the
+    settings_key of the hook, for the push, see scan_blob.
+
+    Hooks register their checks before any of them is run, so that
+    the first hook to read a blob runs the checks of all hooks on it.
+    Checks are dropped on cleanup.
+    '''
+    with _scans_lock:
+        _scans[key] = (scanner, max_bytes)
+
+
+def scan_blobs(repo_dir, key, scanner, blobs, max_bytes=0):
+    '''
+    Get the verdicts of content check 'scanner' on 'blobs', see
+    scan_blob. 'key', usually the settings_key of the hook, names the
+    check. Return a dictionary {blob: verdict}.
+
+    Each blob is read once per push for all the checks registered with
+    register_scan, so that the other hooks find their verdicts on it
+    ready. Verdicts are kept until cleanup.
+    '''
+    with _scans_lock:
+        _scans.setdefault(key, (scanner, max_bytes))
+
+    verdicts = {}
+    for blob in blobs:
+        with _scans_done:
+            # Wait for another hook reading the blob for this check
+            while key in _scan_reading.get(blob, ()):
+                _scans_done.wait()
+
+            results = _scan_results.get(blob, {})
+            if key in results:
+                verdicts[blob] = results[key]
+                continue
+
+            reading = _scan_reading.setdefault(blob, set())
+            scans = [(scan_key,) + scan for scan_key, scan in _scans.items()
+                     if scan_key not in results and scan_key not in reading]
+            keys = set(scan_key for scan_key, _, _ in scans)
+            reading.update(keys)
+
+        scanned = {}
+        try:
+            scanned = scan_blob(repo_dir, blob, scans)
+        finally:
+            # On errors the waiting hooks scan the blob themselves
+            with _scans_done:
+                reading = _scan_reading[blob]
+                reading.difference_update(keys)
+                if not reading:
+                    del _scan_reading[blob]
+                _scan_results.setdefault(blob, {}).update(scanned)
+                _scans_done.notify_all()
+
+        verdicts[blob] = scanned[key]
+
+    return verdicts
+
+
+class VerdictCache(object):
+    '''
+    Persistent cache of hook verdicts on blobs, kept in an sqlite
+    database. A verdict is any JSON serializable value, cached by
+    (hook, settings hash, blob hash). The least recently used
+    verdicts are evicted when there are more than 'max_entries'.
+
+    Commits a hook passed are kept too, by (hook, settings hash,
+    commit hash), so that the hook skips them when they are pushed
+    again. They are recorded only once the push is accepted.
+
+    Updates are kept in memory and written in a single transaction
+    on flush. The cache is best effort: any database error disables
+    it and the hooks recheck the blobs.
+    '''
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = None
+        self.pending = {}
+        self.touched = set()
+        self.hits = 0
+        self.misses = 0
+        self.validating = set()
+        self.validated = set()
+        self.validated_hits = 0
+        self.validated_misses = 0
+
+    def __connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS verdicts '
+                            '(key TEXT PRIMARY KEY, verdict TEXT, atime INTEGER)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS verdicts_atime ON verdicts (atime)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS validated '
+                            '(key TEXT PRIMARY KEY, atime INTEGER)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS validated_atime ON validated (atime)')
+            self.db.commit()
+        return self.db
+
+    def __disable(self, err):
+        logging.warning("Verdict cache '%s' disabled: %s", self.path, err)
+        self.path = None
+
+    def get(self, hook_key, blob):
+        '''
+        Get the verdict of hook 'hook_key' on 'blob' or None.
+        '''
+        key = hook_key + ':' + blob
+        with self.lock:
+            if key in self.pending:
+                self.hits += 1
+                return self.pending[key]
+            if self.path is None:
+                self.misses += 1
+                return None
+            try:
+                row = self.__connect().execute('SELECT verdict FROM verdicts WHERE key = ?', (key,)).fetchone()
+            except sqlite3.Error as err:
+                self.__disable(err)
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.touched.add(key)
+            return json.loads(row[0])
+
+    def put(self, hook_key, blob, verdict):
+        '''
+        Cache the verdict of hook 'hook_key' on 'blob'.
+        '''
+        with self.lock:
+            self.pending[hook_key + ':' + blob] = verdict
+
+    def is_validated(self, hook_key, commit):
+        '''
+        Check if hook 'hook_key' passed 'commit' in an accepted push.
+        '''
+        key = hook_key + ':' + commit
+        with self.lock:
+            if key in self.validated:
+                self.validated_hits += 1
+                return True
+            if self.path is None:
+                self.validated_misses += 1
+                return False
+            try:
+                row = self.__connect().execute('SELECT key FROM validated WHERE key = ?', (key,)).fetchone()
+            except sqlite3.Error as err:
+                self.__disable(err)
+                row = None
+
+            if row is None:
+                self.validated_misses += 1
+                return False
+
+            # Refresh the access time on flush
+            self.validated_hits += 1
+            self.validated.add(key)
+            return True
+
+    def validate(self, hook_key, commit):
+        '''
+        Record that hook 'hook_key' passed 'commit', once accept
+        is called.
+        '''
+        with self.lock:
+            self.validating.add(hook_key + ':' + commit)
+
+    def accept(self):
+        '''
+        Keep the commits passed since the last flush.
+        '''
+        with self.lock:
+            self.validated.update(self.validating)
+            self.validating = set()
+
+    def flush(self):
+        '''
+        Write the new verdicts, accepted commits and access times,
+        evict the least recently used verdicts and commits. Drop
+        the commits that were not accepted.
+        '''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            touched, self.touched = self.touched, set()
+            validated, self.validated = self.validated, set()
+            self.validating = set()
+            if self.path is None or not (pending or touched or validated):
+                return
+
+            now = int(time.time())
+            try:
+                db = self.__connect()
+                db.executemany('UPDATE verdicts SET atime = ? WHERE key = ?',
+                               [(now, key) for key in touched])
+                db.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)',
+                               [(key, json.dumps(verdict), now) for key, verdict in pending.items()])
+                db.executemany('INSERT OR REPLACE INTO validated VALUES (?, ?)',
+                               [(key, now) for key in validated])
+                for table in ('verdicts', 'validated'):
+                    count = db.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+                    if count > self.max_entries:
+                        db.execute('DELETE FROM %s WHERE key IN '
+                                   '(SELECT key FROM %s ORDER BY atime LIMIT ?)' % (table, table),
+                                   (count - self.max_entries,))
+                db.commit()
+            except sqlite3.Error as err:
+                self.__disable(err)
+
+    def close(self):
+        '''
+        Flush and close the database.
+        '''
+        self.flush()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+_verdict_caches = {}
+_verdict_caches_lock = threading.Lock()
+
+
+def get_verdict_cache(params):
+    '''
+    Get the VerdictCache shared by all hooks, as configured by
+    'cache_dir' and 'verdict_cache_size' in hook params. Return
+    None if the cache is disabled.
+    '''
+    try:
+        max_entries = int(params.get('verdict_cache_size', 100000))
+    except ValueError:
+        logging.error("Invalid 'verdict_cache_size' setting: '%s'", params['verdict_cache_size'])
+        return None
+
+    if not max_entries or not params.get('cache_dir'):
+        return None
+
+    path = os.path.join(params['cache_dir'], 'verdicts.sqlite')
+    with _verdict_caches_lock:
+        cache = _verdict_caches.get(path)
+        if cache is None:
+            cache = _verdict_caches[path] = VerdictCache(path, max_entries)
+
+    return cache
+
+
+def accept_push():
+    '''
+    Keep the commits the hooks passed during a run, see
+    VerdictCache.validate. Call when the push is accepted.
+    '''
+    with _verdict_caches_lock:
+        caches = _verdict_caches.values()
+
+    for cache in caches:
+        cache.accept()
+
+
+def settings_key(hook, settings):
+    '''
+    Make a key that identifies 'hook' run with 'settings'.
+    '''
+    return hook + ':' + hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+
+
+def cleanup():
+    '''
+    Release the resources shared by the hooks during a run.
+    '''
+    with _blob_readers_lock:
+        readers = _blob_readers.values()
+        _blob_readers.clear()
+
+    for reader in readers:
+        reader.close()
+
+    with _attr_indexes_lock:
+        for idx_file in _attr_indexes.values():
+            os.remove(idx_file)
+        _attr_indexes.clear()
+
+    # Refs are updated by the push
+    parse_git_log.clear()
+    parse_git_tip.clear()
+
+    with _pushes_lock:
+        _pushes.clear()
+
+    with _scans_lock:
+        _scans.clear()
+        _scan_reading.clear()
+        _scan_results.clear()
+
+    with _verdict_caches_lock:
+        caches = _verdict_caches.values()
+        _verdict_caches.clear()
+
+    for cache in caches:
+        cache.close()
+
+    with _outbox_lock:
+        if _outbox:
+            logging.warning("Dropped %d unsent mails", sum(len(texts) for texts in _outbox.values()))
+        _outbox.clear()
+
+    close_mailers()
+
+    with _spool_lock:
+        spool_dirs = list(_spool_dirs)
+        _spool_dirs.clear()
+
+    for spool_dir in spool_dirs:
+        start_flush_spool(spool_dir)
 
 
 @Memoized
@@ -112,6 +1062,7 @@ def parse_git_log(repo, branch, old_sha, new_sha, this_branch_only=True):
     Parse 'git log' output. Return an array of dictionaries:
         {
             'commit': commit hash,
+            'parents': a list of parent commit hashes,
             'author_name': commit author name,
             'author_email': commit author email,
             'date': commit date,
@@ -122,8 +1073,8 @@ def parse_git_log(repo, branch, old_sha, new_sha, this_branch_only=True):
     When this_branch_only is False, do not include commits that
     exist in repo in 'git log' output.
     '''
-    git_commit_fields = ['commit', 'author_name', 'author_email', 'date', 'message']
-    git_log_format = '%x1f'.join(['%H', '%an', '%ae', '%ad', '%s']) + '%x1e'
+    git_commit_fields = ['commit', 'parents', 'author_name', 'author_email', 'date', 'message']
+    git_log_format = '%x1f'.join(['%H', '%P', '%an', '%ae', '%ad', '%s']) + '%x1e'
 
     cmd = ['git', 'log', '--format=' + git_log_format]
     if old_sha == '0' * 40:
@@ -139,30 +1090,133 @@ def parse_git_log(repo, branch, old_sha, new_sha, this_branch_only=True):
     # See http://stackoverflow.com/questions/5720343/
     # Exclude commits that exist in the repo
     if not this_branch_only:
-        # Get all refs in the repo
-        _, refs, _ = run(['git', 'for-each-ref', '--format=%(refname)'], repo)
-        refs = refs.splitlines()
-        # Remove the branch being pushed
-        if branch in refs:
-            refs.remove(branch)
+        # Let git match all refs in the repo but the branch being pushed
+        # rather than listing them on the command line
+        cmd += ['--not', '--exclude=' + branch, '--glob=refs/*']
 
-        if refs:
-            cmd += ['--ignore-missing', '--not'] + refs
+    # Logging every commit of a long push is costly, check once
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
-    _, log, _ = run(cmd, repo)
+    log = []
+    for row in iter_run(cmd, repo, sep='\x1e'):
+        row = row.strip()
+        if not row:
+            continue
+
+        raw = dict(zip(git_commit_fields, row.split("\x1f")))
+        raw['parents'] = raw['parents'].split()
+        if debug:
+            logging.debug("Parsed commit: %s", raw)
+        log.append(raw)
 
     if not log:
         logging.debug("parse_git_log: empty log")
         return {}
 
-    log = log.strip('\n\x1e').split("\x1e")
-    log = [row.strip().split("\x1f") for row in log]
-    log = [dict(zip(git_commit_fields, row)) for row in log]
+    return log
+
 
-    for raw in log:
-        logging.debug("Parsed commit: %s", raw)
+git_raw_fields = ('old_blob', 'new_blob', 'status', 'path')
 
-    return log
+
+# Pushes registered by load_push and not parsed yet, by repository
+_pushes = {}
+_pushes_lock = threading.Lock()
+
+
+def load_push(repo, refs):
+    '''
+    Register the refs of a push, so that the modified files of all
+    its commits are parsed with a single 'git diff-tree --stdin' call
+    the first time parse_git_show is called in 'repo', rather than
+    with 'git show' per commit. Pushes no hook shows are not parsed.
+
+    - refs: an array of (old_sha, new_sha, branch) tuples
+    '''
+    with _pushes_lock:
+        _pushes[repo] = refs
+
+
+def _parse_push(repo):
+    '''
+    Parse the push registered for 'repo' by load_push, if any.
+    '''
+    with _pushes_lock:
+        refs = _pushes.pop(repo, None)
+        if refs:
+            # Hold the lock, so that other hooks wait for the push
+            # rather than show its commits one by one
+            _diff_tree_push(repo, refs)
+
+
+def _diff_tree_push(repo, refs):
+    commits = []
+    for old_sha, new_sha, branch in refs:
+        # Skip branches being deleted
+        if new_sha == '0' * 40:
+            continue
+        # The commits the hooks show, see parse_git_tip
+        commits += parse_git_log(repo, branch, old_sha, new_sha, this_branch_only=False)
+
+    shows = {}
+    stdin = []
+    for commit in commits:
+        if commit['commit'] in shows:
+            continue
+        # Compare with the first parent only, like 'git show --first-parent'
+        stdin.append(' '.join([commit['commit']] + commit['parents'][:1]))
+        shows[commit['commit']] = []
+
+    if not stdin:
+        return
+
+    cmd = ['git', 'diff-tree', '--stdin', '-r', '--root', '--no-abbrev', '-z']
+    out = iter_run(cmd, repo, input='\n'.join(stdin) + '\n', sep='\0')
+
+    # Parse 'git diff-tree -z' output: each commit hash is followed by
+    # raw lines, ':<old mode> <new mode> <old blob> <new blob> <status>',
+    # and paths, NUL terminated.
+    modfiles = None
+    for chunk in out:
+        if not chunk.startswith(':'):
+            if chunk:
+                modfiles = shows[chunk.strip()]
+            continue
+
+        raw = chunk[1:].split(' ')
+        path = next(out)
+        if len(raw) != 5 or raw[4] not in ('M', 'A', 'D'):
+            logging.error("Could not parse 'git diff-tree' output: '%s %s'", chunk, path)
+            continue
+
+        modfiles.append(dict(zip(git_raw_fields, raw[2:] + [path])))
+
+    for sha, modfiles in shows.items():
+        git_show_raw.prime(modfiles, repo, sha)
+
+
+@memoize(maxsize=65536)
+def git_show_raw(repo, sha):
+    '''
+    Parse 'git show --raw' output of commit 'sha'.
+    See parse_git_show.
+    '''
+    cmd = ['git', 'show', '--first-parent', '--no-renames', '--raw', '--no-abbrev', '--format=', sha]
+    _, show, _ = run(cmd, repo)
+
+    modfiles = []
+    for line in show.splitlines():
+        # Parse git raw lines:
+        # :100755 100755 7469841... 7399137... M  githooks.py
+        match = re.match(r"^:\d{6}\s\d{6}\s([a-z0-9]{40})\s([a-z0-9]{40})\s([MAD])\s+(.+)$",
+                         line)
+        if not match:
+            logging.error("Could not parse 'git show' output: '%s'" % line)
+            continue
+
+        modfiles.append(dict(zip(git_raw_fields, match.groups())))
+
+    return modfiles
 
 
 def parse_git_show(repo, sha, extensions=None):
@@ -175,6 +1229,8 @@ def parse_git_show(repo, sha, extensions=None):
             'new_blob': new blob hash
         }
     for each modified file.
+
+    Commits of the push registered by load_push are not shown again.
     '''
     def extension_match(filepath, extensions=None):
         '''
@@ -187,74 +1243,418 @@ def parse_git_show(repo, sha, extensions=None):
         return any(filepath.endswith(ext) for ext in extensions)
 
     assert sha != '0' * 40
-    cmd = ['git', 'show', '--first-parent', '--raw', '--no-abbrev', '--format=', sha]
-    _, show, _ = run(cmd, repo)
 
-    git_show_fields = ('old_blob', 'new_blob', 'status', 'path')
-    show_json = []
-    for line in show.splitlines():
-        # Parse git raw lines:
-        # :100755 100755 7469841... 7399137... M  githooks.py
-        match = re.match(r"^:\d{6}\s\d{6}\s([a-z0-9]{40})\s([a-z0-9]{40})\s([MAD])\s+(.+)$",
-                         line)
-        if not match:
-            logging.error("Could not parse 'git show' output: '%s'" % line)
-            continue
+    _parse_push(repo)
+    modfiles = git_show_raw(repo, sha)
 
-        # Check if file extension matches any of the passed.
-        path = match.group(4)
-        if extension_match(path, extensions):
-            show_json.append(dict(zip(git_show_fields, match.groups())))
-            logging.debug("Parsed modfile: %s", show_json[-1])
+    # Check if file extension matches any of the passed.
+    show_json = [modfile for modfile in modfiles if extension_match(modfile['path'], extensions)]
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for modfile in show_json:
+            logging.debug("Parsed modfile: %s", modfile)
 
     return show_json
 
 
-def send_mail(mail_to, smtp_from, subject, smtp_server, smtp_port):
+# The tree of a commit with no files, base of a diff for root commits
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+
+@Memoized
+def parse_git_tip(repo, branch, old_sha, new_sha, this_branch_only=True):
     '''
-    Connect to the server once and send all mails
-    from 'mail_to' dictionary. Contains emails as
-    keys and messages to send as values.
+    Parse the files modified from old_sha to new_sha as a whole, with
+    a single 'git diff-tree', for hooks that check the final contents
+    of files only. Return an array of dictionaries as parse_git_show
+    does, for the files modified by the commits that parse_git_log
+    returns.
 
-    smtp_to: the sender
-    subject: subject line, common for all mails
+    A new branch is compared with the first parent of its oldest
+    commit, or with the empty tree if there is none.
     '''
-    if not mail_to:
-        logging.debug('No mails to send (send_mail)')
-        return
+    assert new_sha != '0' * 40
+
+    log = parse_git_log(repo, branch, old_sha, new_sha, this_branch_only)
+    if not log:
+        return []
 
-    logging.debug("Connecting to the server '%s:%s'", smtp_server, smtp_port)
-    smtp = smtplib.SMTP(smtp_server, smtp_port)
-    logging.debug('Connected.')
-    smtp.set_debuglevel(0)
+    # Changes that came with commits pushed before are not checked
+    paths = set(modfile['path'] for commit in log for modfile in parse_git_show(repo, commit['commit']))
 
-    for send_to in mail_to:
-        text = mail_to[send_to]
+    if old_sha != '0' * 40:
+        base = old_sha
+    elif log[-1]['parents']:
+        base = log[-1]['parents'][0]
+    else:
+        base = EMPTY_TREE
+
+    cmd = ['git', 'diff-tree', '-r', '--no-renames', '--no-abbrev', '-z', base, new_sha]
+    out = iter_run(cmd, repo, sep='\0')
 
-        msg_root = MIMEMultipart('related')
-        msg_root['From'] = smtp_from
-        msg_root['To'] = send_to
-        msg_root['Date'] = formatdate(localtime=True)
-        msg_root['Message-ID'] = make_msgid()
-        msg_root['Subject'] = subject
-        msg_root.preamble = 'This is a multi-part message in MIME format.'
+    # See _diff_tree_push for 'git diff-tree -z' output
+    modfiles = []
+    for chunk in out:
+        if not chunk.startswith(':'):
+            continue
 
-        msg = MIMEMultipart('alternative')
-        msg.set_charset('utf-8')
+        raw = chunk[1:].split(' ')
+        path = next(out)
+        if len(raw) != 5 or raw[4] not in ('M', 'A', 'D'):
+            logging.error("Could not parse 'git diff-tree' output: '%s %s'", chunk, path)
+            continue
 
-        msg_root.attach(msg)
+        if path in paths:
+            modfiles.append(dict(zip(git_raw_fields, raw[2:] + [path])))
 
-        # Wrapping text to the simple html header
-        text = '<HTML><BODY><div><pre>' + text + '</pre></div></BODY></HTML>'
+    return modfiles
 
-        # Attaching text to the letter
-        msg_text = MIMEText(text.encode(
-            'utf-8', 'replace'), 'html', _charset='utf-8')
-        msg.attach(msg_text)
 
-        email_file_data = msg_root.as_string()
+def get_branches_containing(repo, commits):
+    '''
+    Find the branches that contain each of 'commits' at once, instead
+    of running 'git branch --contains' per commit. Return a dictionary
+    of arrays of branch names, sorted as 'git branch' lists them:
+        {
+            commit: [branch, ...],
+            ...
+        }
+
+    Only the history that is not reachable from the merge base of
+    'commits' is walked, once for all of them.
+    '''
+    commits = set(commits)
+    if not commits:
+        return {}
+
+    _, out, _ = run(['git', 'for-each-ref', '--format=%(objectname) %(refname)', 'refs/heads/'], repo)
+    tips = {}
+    for line in out.splitlines():
+        sha, ref = line.split(' ', 1)
+        tips.setdefault(sha, []).append(ref[len('refs/heads/'):])
+
+    # No descendant of a commit is an ancestor of the merge base
+    # of all commits, so the history below it can be skipped.
+    ret, base, _ = run(['git', 'merge-base', '--octopus'] + sorted(commits), repo, check_ret=False)
+    stdin = tips.keys()
+    if ret == 0 and base.strip():
+        stdin.append('^' + base.strip())
+
+    children = {}
+    if tips:
+        cmd = ['git', 'rev-list', '--parents', '--stdin']
+        for line in iter_run(cmd, repo, input='\n'.join(stdin) + '\n'):
+            line = line.split(' ')
+            for parent in line[1:]:
+                children.setdefault(parent, []).append(line[0])
+
+    contains = {}
+    for commit in commits:
+        # Walk the descendants of the commit and collect branch tips
+        branches = []
+        seen = set([commit])
+        queue = [commit]
+        while queue:
+            sha = queue.pop()
+            branches += tips.get(sha, [])
+            for child in children.get(sha, []):
+                if child not in seen:
+                    seen.add(child)
+                    queue.append(child)
+
+        contains[commit] = sorted(branches)
+
+    return contains
+
+
+def get_head_branch(repo):
+    '''
+    Get the name of the branch HEAD points to or None.
+    '''
+    ret, out, _ = run(['git', 'symbolic-ref', '-q', 'HEAD'], repo, check_ret=False)
+    if ret != 0 or not out.startswith('refs/heads/'):
+        return None
+
+    return out.strip()[len('refs/heads/'):]
+
+
+def compose_message(smtp_from, send_to, subject, text):
+    '''
+    Build the MIME message for mail 'text' to 'send_to'.
+    '''
+    # Most pushes send no mail, import on first use
+    from email.MIMEMultipart import MIMEMultipart
+    from email.MIMEText import MIMEText
+    from email.Utils import formatdate, make_msgid
+
+    msg_root = MIMEMultipart('related')
+    msg_root['From'] = smtp_from
+    msg_root['To'] = send_to
+    msg_root['Date'] = formatdate(localtime=True)
+    msg_root['Message-ID'] = make_msgid()
+    msg_root['Subject'] = subject
+    msg_root.preamble = 'This is a multi-part message in MIME format.'
+
+    msg = MIMEMultipart('alternative')
+    msg.set_charset('utf-8')
+
+    msg_root.attach(msg)
+
+    # Wrapping text to the simple html header
+    text = '<HTML><BODY><div><pre>' + text + '</pre></div></BODY></HTML>'
+
+    # Attaching text to the letter
+    msg_text = MIMEText(text.encode(
+        'utf-8', 'replace'), 'html', _charset='utf-8')
+    msg.attach(msg_text)
+
+    return msg_root.as_string()
+
+
+class Mailer(object):
+    '''
+    SMTP connection to 'smtp_server' shared by all hooks in a run.
+    Connects on the first mail and reconnects if the server drops
+    the connection in between.
+    '''
+    def __init__(self, smtp_server, smtp_port):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.lock = threading.Lock()
+        self.smtp = None
+
+    def send(self, smtp_from, send_to, message):
+        import smtplib
+
+        with self.lock:
+            for attempt in (1, 2):
+                if self.smtp is None:
+                    logging.debug("Connecting to the server '%s:%s'", self.smtp_server, self.smtp_port)
+                    self.smtp = smtplib.SMTP(self.smtp_server, self.smtp_port)
+                    logging.debug('Connected.')
+                    self.smtp.set_debuglevel(0)
+
+                try:
+                    self.smtp.sendmail(smtp_from, send_to, message)
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    self.smtp = None
+                    if attempt == 2:
+                        raise
 
-        smtp.sendmail(smtp_from, send_to, email_file_data)
         logging.debug("Sent outgoing email to '%s'", send_to)
 
-    smtp.close()
+    def close(self):
+        with self.lock:
+            if self.smtp is not None:
+                try:
+                    self.smtp.quit()
+                except Exception as err:
+                    logging.warning("Could not close SMTP connection: %s", err)
+                self.smtp = None
+
+
+_mailers = {}
+_mailers_lock = threading.Lock()
+
+# Mails queued in a run, see flush_mail
+_outbox = {}
+_outbox_lock = threading.Lock()
+
+# Spool directories mails were put to in a run, see cleanup
+_spool_dirs = set()
+_spool_lock = threading.Lock()
+_spool_count = [0]
+
+
+def get_mailer(smtp_server, smtp_port):
+    '''
+    Get the Mailer for 'smtp_server' shared by all hooks, see cleanup.
+    '''
+    with _mailers_lock:
+        mailer = _mailers.get((smtp_server, smtp_port))
+        if mailer is None:
+            mailer = _mailers[(smtp_server, smtp_port)] = Mailer(smtp_server, smtp_port)
+
+    return mailer
+
+
+def spool_mail(spool_dir, smtp_server, smtp_port, smtp_from, send_to, subject, text, digest_window=0):
+    '''
+    Put a mail to 'spool_dir' for flush_spool to send it. A spool
+    file holds a JSON line with the envelope followed by the text.
+    '''
+    with _spool_lock:
+        _spool_count[0] += 1
+        now = time.time()
+        name = '%d-%d-%d.mail' % (now * 1000, os.getpid(), _spool_count[0])
+        _spool_dirs.add(spool_dir)
+
+    if not os.path.isdir(spool_dir):
+        os.makedirs(spool_dir)
+
+    envelope = json.dumps({'smtp_server': smtp_server, 'smtp_port': smtp_port,
+                           'smtp_from': smtp_from, 'send_to': send_to, 'subject': subject,
+                           'time': now, 'digest_window': digest_window})
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    # Write to a hidden file and rename, so that flush_spool
+    # never sees a partial mail
+    fd, tmp_path = tempfile.mkstemp(dir=spool_dir, prefix='.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(envelope + '\n' + text)
+    os.rename(tmp_path, os.path.join(spool_dir, name))
+
+    logging.debug("Spooled outgoing email to '%s' as '%s'", send_to, name)
+
+
+def flush_spool(spool_dir):
+    '''
+    Send the mails from 'spool_dir', removing the sent ones. Mails
+    with the same envelope and subject are sent as one digest when
+    the first of them is 'digest_window' seconds old; the process
+    waits for that. Only one process sends at a time; mails that
+    fail to send are retried on the next flush.
+    '''
+    import fcntl
+
+    def pending():
+        return sorted(name for name in os.listdir(spool_dir) if name.endswith('.mail'))
+
+    def flush():
+        '''
+        Send the mails that are due. Return the seconds until the
+        next digest is due, None if there is none, False on error.
+        '''
+        digests = {}
+        for name in pending():
+            with open(os.path.join(spool_dir, name)) as f:
+                envelope = json.loads(f.readline())
+                text = f.read().decode('utf-8')
+
+            key = tuple(envelope[field] for field in ('smtp_server', 'smtp_port', 'smtp_from',
+                                                      'send_to', 'subject'))
+            digests.setdefault(key, []).append((name, envelope, text))
+
+        wait = None
+        for key, mails in sorted(digests.items()):
+            smtp_server, smtp_port, smtp_from, send_to, subject = key
+
+            # Mails are in the order they were spooled
+            first = mails[0][1]
+            due = first['time'] + first['digest_window'] - time.time()
+            if due > 0:
+                wait = due if wait is None else min(wait, due)
+                continue
+
+            message = compose_message(smtp_from, send_to, subject,
+                                      '\n'.join(text for name, envelope, text in mails))
+            try:
+                get_mailer(smtp_server, smtp_port).send(smtp_from, send_to, message)
+            except Exception as err:
+                logging.error("Could not send %s: %s", ', '.join(name for name, _, _ in mails), err)
+                return False
+
+            for name, envelope, text in mails:
+                os.remove(os.path.join(spool_dir, name))
+
+        return wait
+
+    with open(os.path.join(spool_dir, '.lock'), 'w') as lock:
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Another process is flushing, it will see our mails
+                return
+
+            try:
+                # Wait for digests with the lock held, so that the
+                # flushers started meanwhile exit; mails they were
+                # started for are found on the next scan
+                wait = flush()
+                while wait:
+                    close_mailers()
+                    time.sleep(wait)
+                    wait = flush()
+                if wait is False:
+                    return
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                close_mailers()
+
+            # Mails spooled after the last scan, by a process
+            # that failed to take the lock
+            if not pending():
+                return
+
+
+def start_flush_spool(spool_dir):
+    '''
+    Run flush_spool on 'spool_dir' in a detached background process.
+    '''
+    code = ('import sys, logging; sys.path.insert(0, sys.argv[1]); import hookutil; '
+            'logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO); '
+            'hookutil.flush_spool(sys.argv[2])')
+
+    # Errors go to spool_dir/flush.log
+    with open(os.devnull, 'r+') as devnull:
+        with open(os.path.join(spool_dir, 'flush.log'), 'a') as log:
+            subprocess.Popen([sys.executable, '-c', code, os.path.dirname(os.path.abspath(__file__)), spool_dir],
+                             stdin=devnull, stdout=devnull, stderr=log,
+                             close_fds=True, preexec_fn=os.setsid)
+
+
+def close_mailers():
+    with _mailers_lock:
+        mailers = _mailers.values()
+        _mailers.clear()
+
+    for mailer in mailers:
+        mailer.close()
+
+
+def send_mail(mail_to, smtp_from, subject, smtp_server, smtp_port, spool_dir=None, digest_window=0):
+    '''
+    Queue all mails from 'mail_to' dictionary. Contains
+    emails as keys and messages to send as values.
+
+    Mails are sent by flush_mail at the end of the run, one per
+    recipient and subject however many refs and hooks queued them,
+    over a connection to the server shared by all hooks. With
+    'spool_dir', they are put there and sent by a background process
+    instead, merged with the mails to the same recipient spooled in
+    the following 'digest_window' seconds.
+
+    smtp_to: the sender
+    subject: subject line, common for all mails
+    '''
+    if not mail_to:
+        logging.debug('No mails to send (send_mail)')
+        return
+
+    digest_window = int(digest_window or 0)
+
+    with _outbox_lock:
+        for send_to in mail_to:
+            key = (smtp_server, smtp_port, smtp_from, send_to, subject, spool_dir, digest_window)
+            _outbox.setdefault(key, []).append(mail_to[send_to])
+
+
+def flush_mail():
+    '''
+    Send or spool the mails queued by send_mail.
+    '''
+    with _outbox_lock:
+        outbox = sorted(_outbox.items())
+        _outbox.clear()
+
+    for key, texts in outbox:
+        smtp_server, smtp_port, smtp_from, send_to, subject, spool_dir, digest_window = key
+        text = '\n'.join(texts)
+
+        if spool_dir:
+            spool_mail(spool_dir, smtp_server, smtp_port, smtp_from, send_to, subject, text, digest_window)
+        else:
+            message = compose_message(smtp_from, send_to, subject, text)
+            get_mailer(smtp_server, smtp_port).send(smtp_from, send_to, message)
@@ -17,6 +17,37 @@ import logging
 import hookutil
 
 
+def scan_line_endings():
+    '''
+    Check file contents for mixed lf and crlf, see hookutil.scan_blob.
+    Yields False as soon as both are seen, True at the end of the file
+    otherwise.
+    '''
+    crlf = lf = False
+    cr_end = False
+    chunk = yield
+    while chunk is not None:
+        # A crlf may be split between chunks
+        chunk_crlf = chunk.count('\r\n') + (1 if cr_end and chunk.startswith('\n') else 0)
+        crlf = crlf or chunk_crlf > 0
+        lf = lf or chunk.count('\n') > chunk_crlf
+        if crlf and lf:
+            yield False
+        cr_end = chunk.endswith('\r')
+        chunk = yield
+
+    yield True
+
+
+def has_mixed_le(chunks):
+    '''
+    Check if file contents, passed as an iterable of
+    chunks, contain both lf and crlf. Stops reading as
+    soon as both are seen.
+    '''
+    return not hookutil.feed_scanner(scan_line_endings(), chunks)
+
+
 class Hook(object):
 
     def __init__(self, repo_dir, settings, params):
@@ -24,6 +55,25 @@ class Hook(object):
         self.settings = settings
         self.params = params
 
+        # Check only the first max_scan_bytes of each file (0 for whole files)
+        try:
+            self.max_scan_bytes = int(params.get('max_scan_bytes', 0))
+        except ValueError as err:
+            raise RuntimeError("Invalid 'max_scan_bytes' setting: %s" % str(err))
+
+        # Check the files modified by each commit, or their contents at new_sha only
+        self.mode = params.get('mode', 'commits')
+        if self.mode not in ('commits', 'tip'):
+            raise RuntimeError("Invalid 'mode' setting: '%s'" % self.mode)
+
+        self.cache_key = hookutil.settings_key(__name__, [settings, self.max_scan_bytes])
+
+    def register_scan(self):
+        '''
+        Register the content check for the push, see hookutil.register_scan.
+        '''
+        hookutil.register_scan(self.cache_key, scan_line_endings, self.max_scan_bytes)
+
     def check(self, branch, old_sha, new_sha):
         logging.debug("Run: branch=%s, old_sha=%s, new_sha=%s",
                       branch, old_sha, new_sha)
@@ -39,43 +89,70 @@ class Hook(object):
         # Before the hook is run git has already created
         # a new_sha commit object
 
-        log = hookutil.parse_git_log(self.repo_dir, branch, old_sha, new_sha, this_branch_only=False)
+        # Verdicts on blobs and commits checked before
+        cache = hookutil.get_verdict_cache(self.params)
+
+        commits = []
+        if self.mode == 'tip':
+            # Errors are reported at new_sha
+            modfiles = hookutil.parse_git_tip(self.repo_dir, branch, old_sha, new_sha, this_branch_only=False)
+            commits.append((new_sha, modfiles))
+        else:
+            log = hookutil.parse_git_log(self.repo_dir, branch, old_sha, new_sha, this_branch_only=False)
+            for commit in log:
+                if cache and cache.is_validated(self.cache_key, commit['commit']):
+                    logging.debug("Commit %s passed before, skip", commit['commit'])
+                    continue
+
+                modfiles = hookutil.parse_git_show(self.repo_dir, commit['commit'])
+                commits.append((commit['commit'], modfiles))
 
-        messages = []
-        for commit in log:
-            modfiles = hookutil.parse_git_show(self.repo_dir, commit['commit'])
-
-            def has_mixed_le(file_contents):
-                '''
-                Check if file contains both lf and crlf
-                file_contents = open(file).read()
-                '''
-                if ('\r\n' in file_contents and
-                        '\n' in file_contents.replace('\r\n', '')):
-                    return True
-                return False
+        # Skip deleted files
+        commits = [(sha, [modfile for modfile in modfiles if modfile['status'] != 'D'])
+                   for sha, modfiles in commits]
 
+        # Resolve 'binary' attribute for all modified files at once
+        paths = set(modfile['path'] for sha, modfiles in commits for modfile in modfiles)
+        attrs = hookutil.get_attrs(self.repo_dir, new_sha, paths, ['binary'])
+
+        # Scan the files with no verdicts yet at once
+        verdicts = {}
+        for sha, modfiles in commits:
             for modfile in modfiles:
-                # Skip deleted files
-                if modfile['status'] == 'D':
-                    logging.debug("Deleted %s, skip", modfile['path'])
-                    continue
+                if attrs[modfile['path']]['binary'] != 'set':
+                    verdicts[modfile['new_blob']] = cache.get(self.cache_key, modfile['new_blob']) if cache else None
+        blobs = [blob for blob, verdict in verdicts.items() if verdict is None]
+        scanned = hookutil.scan_blobs(self.repo_dir, self.cache_key, scan_line_endings, blobs, self.max_scan_bytes)
+        for blob, permit_file in scanned.items():
+            verdicts[blob] = permit_file
+            if cache:
+                cache.put(self.cache_key, blob, permit_file)
 
-                binary_attr = hookutil.get_attr(
-                    self.repo_dir, new_sha, modfile['path'], 'binary')
+        messages = []
+        for sha, modfiles in commits:
+            permit_commit = True
+            binary = False
+            for modfile in modfiles:
+                binary_attr = attrs[modfile['path']]['binary']
 
-                if binary_attr != 'set':
-                    cmd = ['git', 'show', modfile['new_blob']]
-                    _, file_contents, _ = hookutil.run(cmd, self.repo_dir)
+                if binary_attr == 'set':
+                    binary = True
+                else:
+                    permit_file = verdicts[modfile['new_blob']]
 
-                    permit_file = not has_mixed_le(file_contents)
                     logging.debug("modfile='%s', permit_file='%s'", modfile['path'], permit_file)
 
                     if not permit_file:
-                        messages.append({'at': commit['commit'],
+                        messages.append({'at': sha,
                             'text': "Error: file '%s' has mixed line endings (CRLF/LF)" % modfile['path']})
 
-                    permit = permit and permit_file
+                    permit_commit = permit_commit and permit_file
+
+            # Files skipped as binary at new_sha may be checked in
+            # another push, so such a commit does not pass on its own
+            if self.mode == 'commits' and permit_commit and not binary and cache:
+                cache.validate(self.cache_key, sha)
+            permit = permit and permit_commit
 
         logging.debug("Permit: %s", permit)
 
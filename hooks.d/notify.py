@@ -45,11 +45,16 @@ class Hook(object):
 
         log = hookutil.parse_git_log(self.repo_dir, branch, old_sha, new_sha)
 
+        shows = [(commit, hookutil.parse_git_show(self.repo_dir, commit['commit'])) for commit in log]
+
+        # Match 'owners' attribute for all modified files in memory
+        paths = set(modfile['path'] for commit, show in shows for modfile in show)
+        owners = hookutil.match_attr(self.repo_dir, new_sha, paths, 'owners')
+
         files = []
-        for commit in log:
-            show = hookutil.parse_git_show(self.repo_dir, commit['commit'])
+        for commit, show in shows:
             for modfile in show:
-                owners_attr = hookutil.get_attr(self.repo_dir, new_sha, modfile['path'], 'owners')
+                owners_attr = owners[modfile['path']]
                 if owners_attr == 'unspecified' or owners_attr == 'unset':
                     continue
                 for owner in set(owners_attr.split(',')):
@@ -121,7 +126,8 @@ class Hook(object):
                 mails = self.compose_mail(branch, old_sha, new_sha)
                 hookutil.send_mail(mails, smtp_from,
                     "%s/%s - Hook notify: Files you subscribed to were modified" % (proj_key, repo_name),
-                    smtp_server, smtp_port)
+                    smtp_server, smtp_port,
+                    self.params.get('mail_spool_dir'), self.params.get('mail_digest_window'))
 
                 return True, []
 
@@ -13,19 +13,51 @@
 pep8hook: A hook to check python scripts style against PEP8. Uses pycodestyle.
 '''
 
-import os
-import tempfile
-import shutil
 import logging
 import hookutil
 
-pycodestyle_available = False
-try:
-    import pycodestyle
-    pycodestyle_available = True
-except ImportError as err:
-    print "Failed to import pycodestyle. Please contact your system administrator. Skipping python style check ..."
-    logging.error("%s! %s", err, "Please make sure pycodestyle is installed on the system.")
+_pycodestyle = None
+
+
+def load_pycodestyle():
+    '''
+    Import pycodestyle on first use, so that pushes which do not
+    get to check python scripts do not pay for it. Return
+    (pycodestyle, Report) or None if pycodestyle is not available.
+    '''
+    global _pycodestyle
+
+    if _pycodestyle is None:
+        try:
+            import pycodestyle
+        except ImportError as err:
+            print "Failed to import pycodestyle. Please contact your system administrator. Skipping python style check ..."
+            logging.error("%s! %s", err, "Please make sure pycodestyle is installed on the system.")
+            _pycodestyle = False
+            return None
+
+        class Report(pycodestyle.BaseReport):
+            '''
+            Collect the results of the checks for all lines of a file
+            as (row, col, code, text) tuples.
+            '''
+            def __init__(self, options):
+                super(Report, self).__init__(options)
+                self.results = []
+
+            def error(self, line_number, offset, text, check):
+                code = super(Report, self).error(line_number, offset, text, check)
+                if code:
+                    self.results.append((self.line_offset + line_number, offset + 1, code, text[5:]))
+                return code
+
+        _pycodestyle = (pycodestyle, Report)
+
+    return _pycodestyle or None
+
+
+# Let a githooks server import pycodestyle before forking
+preload = load_pycodestyle
 
 
 class Hook(object):
@@ -36,10 +68,6 @@ class Hook(object):
 
 
     def check(self, branch, old_sha, new_sha):
-        # Return early if pycodestyle is not available
-        if not pycodestyle_available:
-            return True, []
-
         logging.debug("Run: branch=%s, old_sha=%s, new_sha=%s",
                       branch, old_sha, new_sha)
         logging.debug("params=%s", self.params)
@@ -49,71 +77,86 @@ class Hook(object):
             logging.debug("Deleting the branch, skip the hook")
             return True, []
 
+        # Return early if pycodestyle is not available
+        loaded = load_pycodestyle()
+        if not loaded:
+            return True, []
+        pycodestyle, Report = loaded
+
+        # Results depend on the pycodestyle version too
+        cache_key = hookutil.settings_key(__name__, [self.settings, pycodestyle.__version__])
+
         permit = True
 
         log = hookutil.parse_git_log(self.repo_dir, branch, old_sha, new_sha, this_branch_only=False)
+
+        kwargs = {
+            "reporter" : Report
+        }
+
+        kwargs.update(self.settings or {})
+        logging.debug("pycodestyle.StyleGuide(%s)", kwargs)
+
+        pep8style = pycodestyle.StyleGuide(**kwargs)
+
+        # Results of checks on blobs and commits checked before
+        cache = hookutil.get_verdict_cache(self.params)
+
+        messages = []
         for commit in log:
-            print "Checking commit %s ..." % commit['commit']
+            if cache and cache.is_validated(cache_key, commit['commit']):
+                logging.debug("Commit %s passed before, skip", commit['commit'])
+                continue
 
             # Filter python scripts from the files modified in new_sha
             modfiles = hookutil.parse_git_show(self.repo_dir, commit['commit'], ['.py'])
 
             # Next iteration if there are no modified python scripts in the changeset
             if not modfiles:
+                if cache:
+                    cache.validate(cache_key, commit['commit'])
                 continue
 
-            # Set up a working directory for pycodestyle and fill it with the blobs to be checked
-            pep8_workdir = tempfile.mkdtemp(suffix='pep8')
-
-            for modfile in modfiles:
-                # Skip deleted files
-                if modfile['status'] == 'D':
-                    logging.debug("Deleted '%s', skip", modfile['path'])
-                    continue
-
-                cmd = ['git', 'show', modfile['new_blob']]
-                _, file_contents, _ = hookutil.run(cmd, self.repo_dir)
-
-                file_path = os.path.join(pep8_workdir, modfile['path'])
-                assert(not os.path.exists(file_path))
-
-                file_dir = os.path.join(pep8_workdir, os.path.dirname(modfile['path']))
-                if not os.path.exists(file_dir):
-                    os.makedirs(os.path.join(pep8_workdir, os.path.dirname(modfile['path'])))
-
-                with open(file_path, 'w') as fd:
-                    fd.write(file_contents)
-
             # Get the commit's diff; pycodestyle needs it to report only against modified lines
             cmd = ['git', 'show', '-U0', commit['commit']]
             _, diff, _ = hookutil.run(cmd, self.repo_dir)
 
-            local_dir = os.curdir
-            os.chdir(pep8_workdir)
-            # Run pycodestyle in the working directory we have just prepared.
             selected_lines = pycodestyle.parse_udiff(diff, patterns=['*.py'], parent='')
 
-            kwargs = {
-                "diff"           : True,
-                "paths"          : sorted(selected_lines),
-                "selected_lines" : selected_lines,
-                "reporter"       : pycodestyle.DiffReport
-            }
+            permit_commit = True
+            for modfile in modfiles:
+                # Skip deleted files and files with no lines added
+                if modfile['status'] == 'D' or modfile['path'] not in selected_lines:
+                    logging.debug("No lines to check in '%s', skip", modfile['path'])
+                    continue
 
-            kwargs.update(self.settings)
-            logging.debug("pycodestyle.StyleGuide(%s)", kwargs)
+                results = cache.get(cache_key, modfile['new_blob']) if cache else None
+                if results is None:
+                    file_contents = hookutil.get_blob(self.repo_dir, modfile['new_blob'])
 
-            pep8style = pycodestyle.StyleGuide(**kwargs)
+                    # Check the blob contents in memory
+                    report = Report(pep8style.options)
+                    checker = pycodestyle.Checker(modfile['path'],
+                                                  lines=file_contents.splitlines(True),
+                                                  options=pep8style.options,
+                                                  report=report)
+                    checker.check_all()
 
-            report = pep8style.check_files()
-            os.chdir(local_dir)
+                    results = sorted(report.results)
+                    if cache:
+                        cache.put(cache_key, modfile['new_blob'], results)
 
-            if report.total_errors:
-                permit = False
+                # Report errors against modified lines only
+                for row, col, code, text in results:
+                    if row in selected_lines[modfile['path']]:
+                        messages.append({'at': commit['commit'],
+                            'text': "%s:%d:%d: %s %s" % (modfile['path'], row, col, code, text)})
+                        permit_commit = False
 
-            # Clean up
-            shutil.rmtree(pep8_workdir)
+            if permit_commit and cache:
+                cache.validate(cache_key, commit['commit'])
+            permit = permit and permit_commit
 
-        logging.debug("Permit: %s" % permit)
+        logging.debug("Permit: %s", permit)
 
-        return permit, []
+        return permit, messages
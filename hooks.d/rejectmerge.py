@@ -55,35 +55,24 @@ class Hook(object):
 
         log = hookutil.parse_git_log(self.repo_dir, branch, old_sha, new_sha, this_branch_only=False)
 
+        # Only merge commits are of interest
+        merges = [commit for commit in log if len(commit['parents']) >= 2]
+
+        # Find branches that contain parent commits, all at once
+        branches = hookutil.get_branches_containing(
+            self.repo_dir, [parentCommit for commit in merges for parentCommit in commit['parents']])
+        headBranch = hookutil.get_head_branch(self.repo_dir) if merges else None
+
         messages = []
-        for commit in log:
-            # Parse commit parents
-            cmd = ['git', 'rev-list', '--parents', '-n', '1', commit['commit']]
-            _, out, _ = hookutil.run(cmd, self.repo_dir)
-            parentCommits = out.strip().split(' ')[1:]
-
-            # Skip commit if it is not a merge commit
-            if len(parentCommits) < 2:
-                continue
+        for commit in merges:
+            parentCommits = commit['parents']
 
             logging.debug("Found merge %s, parents: %s %s", commit['commit'][:7], parentCommits[0][:7], parentCommits[1][:7])
 
-            # Find branches that contain parent commits
             parentBranches = []
             for parentCommit in parentCommits:
-                cmd = ['git', 'branch', '--contains', parentCommit]
-                ret, out, err = hookutil.run(cmd, self.repo_dir)
                 # FIXME Skip if parent commit was not found on any branch
-                if not out and not err and not ret:
-                    # These are stdout, stderr and return code that Popen.wait produces for 'git branch --continue'
-                    # with shell=False. When a commit does not exist in the remote, the command should return 129
-                    # and an error meesage in stderr. With shell=True, it does not work as extected either (returns 1
-                    # and git usage in stdout, similar to running just 'git' instead of 'git branch --continue ...').
-                    continue
-                if not out:
-                    parentBranches.append(branch.replace('refs/heads/', ''))
-                else:
-                    parentBranches += [br.replace("* ", "") for br in out.strip().split('\n')]
+                parentBranches += branches[parentCommit]
 
             if len(set(parentBranches)) != 1:
                 continue
@@ -91,12 +80,12 @@ class Hook(object):
             mergedBranch = parentBranches[0]
             logging.debug("All parents are on branch '%s'", mergedBranch)
 
-            # First parent must be on the destination branch
+            # First parent must be on the destination branch, i.e. the
+            # HEAD branch must be the first one to contain it
             firstParent = parentCommits[0]
-            cmd = ['git', 'branch', '--contains', firstParent]
-            _, out, _ = hookutil.run(cmd, self.repo_dir)
+            firstBranches = branches[firstParent]
 
-            if not out.startswith('* '):
+            if not firstBranches or firstBranches[0] != headBranch:
                 permit = False
                 text = '\n'.join(
                     ["Merging a remote branch onto a local branch is prohibited when updating the remote with that local branch.",
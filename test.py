@@ -7,30 +7,32 @@ Unit tests for githooks
 
 How it works:
 
-* Create a workspace tmp/ in cwd, set up a dummy STASH_HOME,
-  a remote repo and a local repo there.
+* Each test creates a workspace in a new temporary directory, with
+  a copy of testhooks.ini that keeps the caches and the log there,
+  a remote repo and a local repo. Tests do not share files, so they
+  can run in parallel processes.
 
-* Replace temp/remote_repo.git/hooks/update in the remote repo with
+* Replace remote_repo.git/hooks/update in the remote repo with
   hook_fixture.py. The hook_fixture.py script doesn’t do anything
-  but dumps the arguments it is called with to a file (branch and
-  2 hashes, old and new).
+  but sends the arguments it is called with (branch and 2 hashes,
+  old and new) to the test over the UNIX socket hook.sock in the
+  workspace.
 
 * Each unit test in test.py modifies the local repo somehow, commits
   the changes and then runs `git push` asynchronously. `git push`
-  invokes the update hook (hook_fixture.py) in tmp/remote_repo.git.
-  The hook script dumps its arguments to a file tmp/request.json.
-
-* The unit test (test.py) waits until tmp/request.json is written,
-  reads it in and removes the file. Then, it instantiates the Hook
-  object from the hook module it tests, and performs various testing
-  using the data from tmp/request.json.
-
-* When the testing is done, the unit test writes a response file
-  tmp/response.json for the update script (the update script waits
-  until it is able to read this file). The response file contains
-  the testing exit code. The update script reads in the file, removes
-  it and returns the exit code to git (asynchronously called from the
-  unit test in test.py).
+  invokes the update hook (hook_fixture.py) in remote_repo.git,
+  which connects to hook.sock and sends its request.
+
+* The unit test (test.py) accepts the connection and reads in the
+  request. Then, it instantiates the Hook object from the hook module
+  it tests, and performs various testing using the data from the
+  request.
+
+* When the testing is done, the unit test sends the response over
+  the same connection and closes it. The response contains the testing
+  exit code. The update script reads in the response and returns the
+  exit code to git (asynchronously called from the unit test in
+  test.py).
 '''
 
 
@@ -38,10 +40,17 @@ import unittest
 import subprocess
 import shutil
 import os
-import multiprocessing
 import json
 import sys
 import logging
+import StringIO
+import threading
+import asyncore
+import smtpd
+import email
+import socket
+import tempfile
+import ConfigParser
 from time import sleep
 
 
@@ -56,51 +65,98 @@ def git(cmd, repo=None):
                                        stderr=subprocess.STDOUT)
 
 def git_async(cmd, repo=None):
-    def call_git(cmd, repo=None, result=None):
-        try:
-            result.put([0, git(cmd, repo)])
-        except subprocess.CalledProcessError, e:
-            result.put([e.returncode, e.output])
-
-    result = multiprocessing.Queue()
-    proc = multiprocessing.Process(target=call_git, args=(cmd, repo, result))
-    proc.start()
-
-    return [proc, result]
+    if repo:
+        cmd = ['-C', repo] + cmd
+    return subprocess.Popen(['git'] + cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
 
 def git_async_result(git_call):
-    git_call[0].join()
-    result = git_call[1].get()
+    output = git_call.communicate()[0]
 
-    if result[0] == 0:
-        return result[1]
+    if git_call.returncode == 0:
+        return output
     else:
-        raise subprocess.CalledProcessError(result[0], 'git', result[1])
+        raise subprocess.CalledProcessError(git_call.returncode, 'git', output)
 
 def write_string(filename, string):
     with open(filename, 'w+') as f:
         f.write(string)
 
 
+def wait_for(condition):
+    attempts = 0
+    while not condition():
+        attempts = attempts + 1
+        if attempts >= 200:
+            raise RuntimeError('Timeout exceeded')
+        sleep(0.1)
+
+
+def recv_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+
+def mail_text(data):
+    message = email.message_from_string(data)
+    return ''.join(part.get_payload(decode=True) for part in message.walk() if not part.is_multipart())
+
+
+class SMTPServer(smtpd.SMTPServer):
+    '''
+    Local SMTP server to send test mails to. Keeps the mails
+    it receives and counts the connections.
+    '''
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.mails = []
+
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.mails.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        asyncore.close_all()
+        self.thread.join()
+
+
 class TestBase(unittest.TestCase):
 
     def setUp(self):
         self.cwd = os.getcwd()
-        self.base = os.path.join(self.cwd, 'tmp')
-        self.cleanUp()
-        os.mkdir(self.base)
+        self.base = tempfile.mkdtemp(prefix='githooks-test-')
 
         self.remote_repo = os.path.join(self.base, 'remote_repo.git')
         self.repo = os.path.join(self.base, 'repo')
+        self.conf_file = os.path.join(self.base, 'test.conf')
+        self.ini_file = os.path.join(self.base, 'testhooks.ini')
 
-        # Create tmp/test.conf
-        with open(os.path.join(self.base, 'test.conf'), 'w') as f:
+        # Create test.conf
+        with open(self.conf_file, 'w') as f:
             f.write(json.dumps({"line_endings":[],
                                 "notify":[],
-                                "email_mention":[]},
+                                "email_mention":[],
+                                "rejectmerge":[],
+                                "pep8hook":{"ignore":["E501"]}},
                                 indent=4))
 
-        gh = githooks.Githooks(conf_file='test.conf', ini_file='testhooks.ini',
+        self.__setup_ini_file()
+
+        gh = githooks.Githooks(conf_file=self.conf_file, ini_file=self.ini_file,
                                repo_dir=self.remote_repo)
 
         self.hooks = dict(zip(gh.conf.keys(), gh.hooks))
@@ -110,8 +166,12 @@ class TestBase(unittest.TestCase):
         self.__setup_local_repo()
         self.__add_remote_repo()
 
-        self.hook_request = os.path.join(self.base, 'request.json')
-        self.hook_response = os.path.join(self.base, 'response.json')
+        # hook_fixture.py connects here from the remote repo
+        self.hook_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.hook_socket.bind(os.path.join(self.base, 'hook.sock'))
+        self.hook_socket.listen(1)
+        self.hook_socket.settimeout(20)
+        self.hook_conn = None
 
         os.chdir(self.repo)
 
@@ -120,6 +180,16 @@ class TestBase(unittest.TestCase):
         if os.path.isdir(base):
             shutil.rmtree(base)
 
+    def __setup_ini_file(self):
+        # Keep the caches and the log in the workspace, use absolute paths
+        ini = ConfigParser.RawConfigParser()
+        ini.read(os.path.join(self.cwd, 'testhooks.ini'))
+        ini.set('DEFAULT', 'conf_dir', self.base)
+        ini.set('DEFAULT', 'log_file', os.path.join(self.base, 'test.log'))
+        ini.set('DEFAULT', 'hooks_dir', os.path.join(self.cwd, ini.get('DEFAULT', 'hooks_dir')))
+        with open(self.ini_file, 'w') as f:
+            ini.write(f)
+
     def __setup_remote_repo(self):
         git(['init', '--bare', self.remote_repo])
         shutil.copy(os.path.join(self.cwd, 'hook_fixture.py'),
@@ -133,32 +203,37 @@ class TestBase(unittest.TestCase):
         git(['remote', 'add', 'origin', self.remote_repo], self.repo)
 
     def get_request(self):
-        request = self.hook_request
+        self.hook_conn, _ = self.hook_socket.accept()
+        self.hook_conn.settimeout(20)
+        return json.loads(recv_all(self.hook_conn))
 
-        attempts = 0
-        while 1:
-            if not os.path.exists(request):
-                attempts = attempts + 1
-                sleep(0.1)
-            else:
-                break
+    def write_response(self, code, data):
+        self.hook_conn.sendall(json.dumps([code, data]))
+        self.close_request()
 
-            if attempts >= 200:
-                raise RuntimeError('Timeout exceeded')
+    def close_request(self):
+        # Subprocesses of the test may hold the connection open
+        self.hook_conn.shutdown(socket.SHUT_RDWR)
+        self.hook_conn.close()
+        self.hook_conn = None
 
-        with open(request) as f:
-            data = f.read()
+    def tearDown(self):
+        import hookutil
+        hookutil.cleanup()
 
-        os.remove(request)
-        return json.loads(data)
+        # A hook still waiting fails the push
+        if self.hook_conn:
+            self.close_request()
+        self.hook_socket.close()
 
-    def write_response(self, code, data):
-        with open(self.hook_response, 'w+') as f:
-            f.write(json.dumps([code, data]))
+        # Let the next test log to its own workspace
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
 
-    def tearDown(self):
         os.chdir(self.cwd)
-        #self.cleanUp()
+        self.cleanUp()
 
 
 class TestBasicHooks(TestBase):
@@ -191,6 +266,820 @@ class TestBasicHooks(TestBase):
         self.assertRegexpMatches(cm.exception.output, ".*hook_failed.*")
 
 
+class TestGithooks(TestBase):
+
+    def run_githooks(self, conf, refs, params={}):
+        '''
+        Run githooks with configuration 'conf' on refs 'refs' in
+        the remote repo. Return the exit code and the output.
+        '''
+        conf_file = os.path.join(self.base, 'run.conf')
+        with open(conf_file, 'w') as f:
+            f.write(json.dumps(conf))
+
+        stdin = os.path.join(self.base, 'stdin')
+        write_string(stdin, ''.join('%s %s %s\n' % ref for ref in refs))
+
+        gh = githooks.Githooks(conf_file=conf_file, ini_file=self.ini_file,
+                               repo_dir=self.remote_repo)
+        gh.params.update(params)
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                gh.run([stdin])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        return cm.exception.code, output
+
+    def test_run_parallel(self):
+        git(['config', 'core.autocrlf', 'false'])
+        write_string('a.txt', 'data\r\n\n')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+        write_string('b.txt', 'data\r\n\n')
+        git(['add', 'b.txt'])
+        git(['commit', '-m', 'second commit'])
+
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        refs = [('0' * 40, request[2], 'refs/heads/master'),
+                ('0' * 40, request[2], 'refs/heads/other')]
+        stats_file = os.path.join(self.base, 'stats.json')
+        sequential = self.run_githooks({'line_endings': []}, refs)
+        parallel = self.run_githooks({'line_endings': []}, refs, {'jobs': '4', 'stats_file': stats_file})
+
+        # CPU time of concurrent checks is not reported
+        with open(stats_file) as f:
+            stats = json.loads(f.read())
+        self.assertEquals([check['cpu'] for check in stats['checks']], [None, None])
+        self.assertEquals(stats['hooks']['line_endings']['cpu'], None)
+
+        self.assertEquals(parallel, sequential)
+        self.assertEquals(parallel[0], 1)
+        first = git(['rev-parse', 'HEAD~']).strip()
+        second = request[2]
+        self.assertEquals(parallel[1].splitlines(), [
+            "[refs/heads/%s @ %s]: Error: file '%s' has mixed line endings (CRLF/LF)" % (branch, sha[:7], path)
+            for branch in ('master', 'other')
+            for sha, path in ((second, 'b.txt'), (first, 'a.txt'))
+        ])
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+
+    def test_serve(self):
+        git(['config', 'core.autocrlf', 'false'])
+        write_string('a.txt', 'data\r\n\n')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        conf_file = os.path.join(self.base, 'run.conf')
+        refs = [(request[1], request[2], request[0])]
+        expected = self.run_githooks({'line_endings': [], 'rejectmerge': []}, refs)
+
+        socket_path = os.path.join(self.base, 'githooks.sock')
+        server = subprocess.Popen([sys.executable, 'githooks.py', '--serve', socket_path, self.ini_file],
+                                  cwd=self.cwd)
+        try:
+            attempts = 0
+            while not os.path.exists(socket_path):
+                attempts = attempts + 1
+                self.assertTrue(attempts < 200, 'Timeout exceeded')
+                sleep(0.1)
+
+            # Only the server's user may connect
+            self.assertEquals(os.stat(socket_path).st_mode & 0777, 0600)
+
+            # git is run from the server's PATH
+            env = dict(os.environ, GITHOOKS_SOCKET=socket_path, PATH=os.path.join(self.base, 'bin'))
+            for _ in range(2):
+                client = subprocess.Popen([sys.executable, os.path.join(self.cwd, 'githooks_client.py'), conf_file],
+                                          cwd=self.remote_repo, env=env,
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                output, _ = client.communicate(''.join('%s %s %s\n' % ref for ref in refs))
+                self.assertEquals((client.returncode, output), expected)
+        finally:
+            server.terminate()
+            server.wait()
+
+        self.assertEquals(expected[0], 1)
+        self.assertFalse(os.path.exists(socket_path))
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_run_stats(self):
+        write_string('a.txt', 'data\n')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        stats_file = os.path.join(self.base, 'stats.json')
+        refs = [(request[1], request[2], request[0])]
+        params = {'stats_file': stats_file, 'profile_dir': self.base}
+        self.assertEquals(self.run_githooks({'line_endings': [], 'rejectmerge': []}, refs, params), (0, ''))
+        self.assertEquals(self.run_githooks({'line_endings': []}, refs, params), (0, ''))
+
+        with open(stats_file) as f:
+            stats = [json.loads(line) for line in f]
+
+        self.assertEquals(len(stats), 2)
+        self.assertTrue(stats[0]['permit'])
+        self.assertEquals(sorted((check['ref'], check['hook'], check['status']) for check in stats[0]['checks']),
+                          [('refs/heads/master', 'line_endings', True), ('refs/heads/master', 'rejectmerge', True)])
+        self.assertEquals(sorted(stats[0]['hooks']), ['line_endings', 'rejectmerge'])
+        self.assertEquals(sorted(stats[0]['refs']), ['refs/heads/master'])
+        self.assertTrue(stats[0]['git']['processes'] > 0)
+        self.assertTrue(stats[0]['git']['bytes'] > 0)
+        self.assertTrue('parse_git_log' in stats[0]['caches'])
+
+        # The commit passed by the first run is not checked again
+        self.assertEquals(stats[1]['caches']['validated'], {'hits': 1, 'misses': 0})
+        self.assertEquals(stats[1]['caches']['verdicts'], {'hits': 0, 'misses': 0})
+
+        profiles = [name for name in os.listdir(self.base) if name.endswith('.prof')]
+        self.assertEquals(len(profiles), 2)
+
+        # Checks run in the pool are profiled too
+        profile_dir = os.path.join(self.base, 'profiles')
+        os.mkdir(profile_dir)
+        params.update({'jobs': '4', 'profile_dir': profile_dir})
+        self.assertEquals(self.run_githooks({'line_endings': [], 'rejectmerge': []}, refs, params), (0, ''))
+
+        import pstats
+        profile = pstats.Stats(os.path.join(profile_dir, os.listdir(profile_dir)[0]))
+        functions = set((os.path.basename(filename), name) for filename, line, name in profile.stats)
+        self.assertTrue(('line_endings.py', 'check') in functions)
+        self.assertTrue(('rejectmerge.py', 'check') in functions)
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_shared_scans(self):
+        write_string('a.txt', 'data\n' * 20000)
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        stats_file = os.path.join(self.base, 'stats.json')
+        refs = [(request[1], request[2], request[0])]
+        params = {'stats_file': stats_file, 'verdict_cache_size': '0'}
+        copyright = [{'start': 'Copyright', 'full': 'Copyright \\(c\\) Test'}]
+        self.assertEquals(self.run_githooks({'line_endings': []}, refs, params), (0, ''))
+        self.assertEquals(self.run_githooks({'line_endings': [], 'copyright': copyright}, refs, params), (0, ''))
+
+        with open(stats_file) as f:
+            stats = [json.loads(line)['git']['bytes'] for line in f]
+
+        # The file is read once for both hooks, one after the other
+        self.assertTrue(stats[0] > 100000)
+        self.assertTrue(stats[1] - stats[0] < 100000)
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_validated_commits(self):
+        git(['config', 'core.autocrlf', 'false'])
+        write_string('a.txt', 'data\n')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+        write_string('b.txt', 'data\r\n\n')
+        git(['add', 'b.txt'])
+        git(['commit', '-m', 'second commit'])
+
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        stats_file = os.path.join(self.base, 'stats.json')
+        first = git(['rev-parse', 'HEAD~']).strip()
+        rejected = [(request[1], request[2], request[0])]
+        accepted = [(request[1], first, request[0])]
+
+        # Commits are recorded only when the push is accepted
+        for refs, code in ((rejected, 1), (accepted, 0), (rejected, 1)):
+            result = self.run_githooks({'line_endings': []}, refs, {'stats_file': stats_file})
+            self.assertEquals(result[0], code)
+
+        with open(stats_file) as f:
+            stats = [json.loads(line)['caches'] for line in f]
+
+        self.assertEquals(stats[0]['validated'], {'hits': 0, 'misses': 2})
+        self.assertEquals(stats[1]['validated'], {'hits': 0, 'misses': 1})
+        self.assertEquals(stats[2]['validated'], {'hits': 1, 'misses': 1})
+        self.assertEquals(stats[2]['verdicts'], {'hits': 1, 'misses': 0})
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_lazy_imports(self):
+        # Importing the hooks does not import the mail, style checker,
+        # server and thread pool modules
+        code = ('import sys; sys.path.append("hooks.d"); '
+                'import githooks, hookutil, line_endings, pep8hook, notify; '
+                'print sorted(m for m in ("smtplib", "email.MIMEText", "pycodestyle", "SocketServer", '
+                '"multiprocessing.pool", "logging.handlers") if m in sys.modules)')
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=self.cwd)
+        self.assertEquals(output.strip(), '[]')
+
+        # Hooks are imported when run
+        write_string('a.txt', 'data\n')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        refs = [(request[1], request[2], request[0])]
+        self.assertEquals(self.run_githooks({'no_such_hook': []}, [], {}), (0, ''))
+        with self.assertRaises(RuntimeError):
+            self.run_githooks({'no_such_hook': []}, refs)
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_load_cached(self):
+        conf_path = os.path.join(self.base, 'cached.conf')
+        cache_path = os.path.join(self.base, '.cached.conf.pickle')
+
+        write_string(conf_path, 'line_endings: []\n')
+        self.assertEquals(githooks.load_cached(conf_path, githooks.parse_conf_file), {'line_endings': []})
+        self.assertTrue(os.path.exists(cache_path))
+
+        # The cache is used while the file stays the same
+        self.assertEquals(githooks.load_cached(conf_path, lambda path: None), {'line_endings': []})
+
+        write_string(conf_path, 'line_endings: []\nrejectmerge: []\n')
+        self.assertEquals(githooks.load_cached(conf_path, githooks.parse_conf_file),
+                          {'line_endings': [], 'rejectmerge': []})
+
+        # Only plain YAML is loaded
+        import yaml
+        write_string(conf_path, 'line_endings: !!python/name:os.system\n')
+        with self.assertRaises(yaml.YAMLError):
+            githooks.load_cached(conf_path, githooks.parse_conf_file)
+
+        write_string(conf_path, '- line_endings\n')
+        with self.assertRaises(RuntimeError):
+            githooks.load_cached(conf_path, githooks.parse_conf_file)
+
+    def test_load_cached_warning(self):
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
+
+        # The .ini cache can not be written
+        cache_path = os.path.join(self.base, '.testhooks.ini.pickle')
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        os.mkdir(cache_path)
+
+        # The warning goes to log_file once it is set up
+        githooks.Githooks(conf_file=self.conf_file, ini_file=self.ini_file, repo_dir=self.remote_repo)
+        self.assertEquals([type(handler) for handler in root.handlers], [logging.FileHandler])
+        with open(os.path.join(self.base, 'test.log')) as f:
+            self.assertTrue("Could not cache '%s'" % self.ini_file in f.read())
+
+    def test_ini_errors(self):
+        ini_file = os.path.join(self.base, 'errors.ini')
+        write_string(ini_file, open(self.ini_file).read() + '[rejectmerge]\nsmtp_from = 50% off\n')
+
+        # A section that does not interpolate is skipped
+        gh = githooks.Githooks(conf_file=self.conf_file, ini_file=ini_file, repo_dir=self.remote_repo)
+        hooks = dict((hook.name, hook) for hook in gh.hooks)
+        self.assertFalse('smtp_from' in hooks['rejectmerge'].params)
+        self.assertEquals(hooks['notify'].params['proj_key'], 'TEST')
+
+    def test_logging(self):
+        gh = githooks.Githooks(conf_file=self.conf_file, ini_file=self.ini_file,
+                               repo_dir=self.remote_repo)
+
+        gh.params['log_level'] = 'LOUD'
+        with self.assertRaises(RuntimeError):
+            gh.configure_logging()
+
+        stream = StringIO.StringIO()
+        handler = githooks.QueueHandler(logging.StreamHandler(stream))
+        logger = logging.getLogger('test_logging')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            args = ['first']
+            logger.warning("Logged %s", args)
+            # Arguments are merged in when the record is queued
+            args[0] = 'second'
+            handler.close()
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEquals(stream.getvalue(), "Logged ['first']\n")
+
+
+class TestHookutil(TestBase):
+
+    def test_get_blob(self):
+        write_string('a.txt', 'data\r\n')
+        write_string('b.txt', '')
+        git(['add', 'a.txt', 'b.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        self.get_request()
+
+        import hookutil
+
+        a_blob = git(['rev-parse', 'HEAD:a.txt']).strip()
+        b_blob = git(['rev-parse', 'HEAD:b.txt']).strip()
+
+        self.assertEquals(hookutil.get_blob(self.repo, a_blob), 'data\r\n')
+        self.assertEquals(hookutil.get_blob(self.repo, b_blob), '')
+        self.assertEquals(hookutil.get_blob(self.repo, a_blob), 'data\r\n')
+        with self.assertRaises(RuntimeError):
+            hookutil.get_blob(self.repo, '1' * 40)
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_iter_blob(self):
+        write_string('a.txt', '0123456789' * 10)
+        write_string('b.txt', 'data')
+        git(['add', 'a.txt', 'b.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        self.get_request()
+
+        import hookutil
+
+        a_blob = git(['rev-parse', 'HEAD:a.txt']).strip()
+        b_blob = git(['rev-parse', 'HEAD:b.txt']).strip()
+
+        self.assertEquals(list(hookutil.iter_blob(self.repo, a_blob, 30)), ['0123456789' * 3] * 3 + ['0123456789'])
+
+        # The rest of a blob is skipped or git restarted when stopped early
+        for drain_limit in (hookutil.BLOB_DRAIN_LIMIT, 0):
+            self.addCleanup(setattr, hookutil, 'BLOB_DRAIN_LIMIT', hookutil.BLOB_DRAIN_LIMIT)
+            hookutil.BLOB_DRAIN_LIMIT = drain_limit
+
+            hookutil.reset_stats()
+            chunks = hookutil.iter_blob(self.repo, a_blob, 30)
+            self.assertEquals(next(chunks), '0123456789' * 3)
+            chunks.close()
+            self.assertEquals(hookutil.get_stats()['git']['bytes'], 100 if drain_limit else 30)
+            self.assertEquals(hookutil.get_blob(self.repo, b_blob), 'data')
+
+        # Stopped after the last chunk
+        chunks = hookutil.iter_blob(self.repo, b_blob)
+        self.assertEquals(next(chunks), 'data')
+        chunks.close()
+        self.assertEquals(hookutil.get_blob(self.repo, a_blob), '0123456789' * 10)
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+
+    def test_scan_blobs(self):
+        write_string('a.txt', 'data\r\n' * 10 + 'data\n')
+        write_string('b.txt', 'data\n')
+        write_string('c.txt', 'data\r\n' + 'data\n' * 40000)
+        git(['add', 'a.txt', 'b.txt', 'c.txt'])
+        git(['commit', '-m', 'initial commit'])
+
+        import hookutil
+
+        a_blob = git(['rev-parse', 'HEAD:a.txt']).strip()
+        b_blob = git(['rev-parse', 'HEAD:b.txt']).strip()
+        c_blob = git(['rev-parse', 'HEAD:c.txt']).strip()
+
+        def scanner(function):
+            # Content check calling 'function' with all the chunks at once
+            def scan():
+                chunks = []
+                chunk = yield
+                while chunk is not None:
+                    chunks.append(chunk)
+                    chunk = yield
+                yield function(chunks)
+            return scan
+
+        scanned = []
+        def count_crlf(chunks):
+            data = ''.join(chunks)
+            scanned.append(data)
+            return data.count('\r\n')
+
+        crlf = scanner(count_crlf)
+        head = scanner(''.join)
+
+        # Checks share a read, each within its own limit
+        hookutil.reset_stats()
+        self.assertEquals(hookutil.scan_blob(self.repo, a_blob, [('test:crlf', crlf, 0),
+                                                                 ('test:head', head, 4)]),
+                          {'test:crlf': 10, 'test:head': 'data'})
+        self.assertEquals(hookutil.get_stats()['git']['bytes'], 65)
+
+        # and stop reading once they have a verdict
+        def mixed():
+            chunk = yield
+            while chunk is not None:
+                if '\r\n' in chunk:
+                    yield True
+                chunk = yield
+            yield False
+
+        self.addCleanup(setattr, hookutil, 'BLOB_DRAIN_LIMIT', hookutil.BLOB_DRAIN_LIMIT)
+        hookutil.BLOB_DRAIN_LIMIT = 0
+
+        hookutil.reset_stats()
+        self.assertEquals(hookutil.scan_blob(self.repo, c_blob, [('test:mixed', mixed, 0)]), {'test:mixed': True})
+        self.assertEquals(hookutil.get_stats()['git']['bytes'], 65536)
+
+        # Each chunk is passed to all checks before the next one is read
+        events = []
+        iter_blob = hookutil.iter_blob
+        def logged_iter_blob(repo_dir, sha):
+            chunks = iter_blob(repo_dir, sha)
+            try:
+                for chunk in chunks:
+                    events.append('read')
+                    yield chunk
+            finally:
+                chunks.close()
+
+        def counter(key):
+            def scan():
+                count = 0
+                chunk = yield
+                while chunk is not None:
+                    events.append(key)
+                    count += 1
+                    chunk = yield
+                yield count
+            return scan
+
+        self.addCleanup(setattr, hookutil, 'iter_blob', iter_blob)
+        hookutil.iter_blob = logged_iter_blob
+        self.assertEquals(hookutil.scan_blob(self.repo, c_blob, [('one', counter('one'), 0),
+                                                                 ('two', counter('two'), 0)]),
+                          {'one': 4, 'two': 4})
+        self.assertEquals(events, ['read', 'one', 'two'] * 4)
+        hookutil.iter_blob = iter_blob
+
+        # All registered checks are run on a blob read for one of them
+        hookutil.register_scan('test:head', head, 4)
+        hookutil.register_scan('test:crlf', crlf)
+        self.assertEquals(hookutil.scan_blobs(self.repo, 'test:head', head, [a_blob], 4), {a_blob: 'data'})
+        self.assertEquals(hookutil.scan_blobs(self.repo, 'test:crlf', crlf, [a_blob, b_blob]), {a_blob: 10, b_blob: 0})
+        self.assertEquals(scanned, ['data\r\n' * 10 + 'data\n'] * 2 + ['data\n'])
+
+        self.assertEquals(hookutil.scan_blobs(self.repo, 'test:crlf', crlf, [b_blob]), {b_blob: 0})
+        self.assertEquals(len(scanned), 3)
+
+        hookutil.cleanup()
+        self.assertEquals(hookutil.scan_blobs(self.repo, 'test:crlf', crlf, [b_blob]), {b_blob: 0})
+        self.assertEquals(len(scanned), 4)
+
+        self.assertEquals(hookutil.read_blob(self.repo, a_blob, 8), 'data\r\nda')
+        self.assertEquals(hookutil.read_blob(self.repo, b_blob, 100), 'data\n')
+
+    def test_load_push(self):
+        write_string('a.txt', 'data')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git(['checkout', '-b', 'feature'])
+        write_string('b.txt', 'data')
+        git(['add', 'b.txt'])
+        git(['commit', '-m', 'feature'])
+        git(['checkout', 'master'])
+        git(['rm', '-q', 'a.txt'])
+        write_string('c d.txt', 'data')
+        git(['add', 'c d.txt'])
+        git(['commit', '-m', 'remove a.txt'])
+        git(['merge', '--no-edit', 'feature'])
+        git(['branch', '-D', 'feature'])
+
+        import hookutil
+
+        new_sha = git(['rev-parse', 'HEAD']).strip()
+        log = hookutil.parse_git_log(self.repo, 'refs/heads/master', '0' * 40, new_sha)
+        self.assertEquals(len(log), 4)
+
+        shows = [hookutil.parse_git_show(self.repo, commit['commit']) for commit in log]
+        hookutil.cleanup()
+
+        # Nothing is run until a commit is shown, then 'git log' and
+        # 'git diff-tree' only
+        hookutil.reset_stats()
+        hookutil.load_push(self.repo, [('0' * 40, new_sha, 'refs/heads/master')])
+        self.assertEquals(hookutil.get_stats()['git']['processes'], 0)
+        self.assertEquals([hookutil.parse_git_show(self.repo, commit['commit']) for commit in log], shows)
+        self.assertEquals(hookutil.get_stats()['git']['processes'], 2)
+        self.assertEquals(hookutil.parse_git_show(self.repo, log[0]['commit'], ['.py']), [])
+        self.assertEquals([[(modfile['status'], modfile['path']) for modfile in show] for show in shows],
+                          [[('A', 'b.txt')], [('D', 'a.txt'), ('A', 'c d.txt')], [('A', 'b.txt')], [('A', 'a.txt')]])
+
+
+    def test_get_branches_containing(self):
+        write_string('a.txt', 'data')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git(['checkout', '-b', 'feature'])
+        write_string('b.txt', 'data')
+        git(['add', 'b.txt'])
+        git(['commit', '-m', 'feature'])
+        git(['checkout', '-b', 'another', 'master'])
+        git(['checkout', 'master'])
+        write_string('c.txt', 'data')
+        git(['add', 'c.txt'])
+        git(['commit', '-m', 'master'])
+        git(['checkout', '-b', 'release'])
+        git(['merge', '--no-edit', 'feature'])
+        git(['checkout', 'master'])
+
+        import hookutil
+
+        commits = git(['rev-list', '--all']).split()
+        branches = hookutil.get_branches_containing(self.repo, commits)
+
+        self.assertEquals(len(branches), 4)
+        for commit in commits:
+            out = git(['branch', '--contains', commit])
+            self.assertEquals(branches[commit], [branch[2:] for branch in out.splitlines()])
+        self.assertEquals(hookutil.get_head_branch(self.repo), 'master')
+
+
+    def test_iter_run(self):
+        import hookutil
+
+        data = ''.join('line %d\n' % i for i in range(100000))
+        out = hookutil.iter_run(['cat'], input=data, bufsize=1000)
+        self.assertEquals(list(out), data.splitlines())
+
+        out = hookutil.iter_run(['printf', 'a\\0b\\0\\0c'], sep='\0')
+        self.assertEquals(list(out), ['a', 'b', '', 'c'])
+
+        out = hookutil.iter_run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEquals(next(out), 'out')
+        with self.assertRaises(subprocess.CalledProcessError):
+            next(out)
+
+        self.assertEquals(list(hookutil.iter_run(['sh', '-c', 'exit 3'], check_ret=False)), [])
+
+    def test_memoized(self):
+        import hookutil
+
+        calls = []
+
+        @hookutil.memoize(maxsize=4)
+        def function(*args, **kwargs):
+            calls.append((args, kwargs))
+            return len(calls)
+
+        self.assertEquals(function(1, a=1, b=2), 1)
+        self.assertEquals(function(1, b=2, a=1), 1)
+        self.assertEquals(function(1, a=2, b=1), 2)
+        self.assertEquals((function.hits, function.misses), (1, 2))
+
+        # Unhashable arguments are not cached
+        self.assertEquals(function([1]), 3)
+        self.assertEquals(function([1]), 4)
+
+        # The least recently used values are evicted
+        for i in range(4):
+            function(1, a=1, b=2)
+            function(i)
+        self.assertEquals(len(function.memoized), 4)
+        self.assertEquals(function(1, a=1, b=2), 1)
+        self.assertEquals(function(0), 9)
+
+        function.clear()
+        self.assertEquals(function(1, a=1, b=2), 10)
+
+        function = hookutil.memoize(ttl=0.1)(function.function)
+        self.assertEquals(function(1), 11)
+        self.assertEquals(function(1), 11)
+        sleep(0.2)
+        self.assertEquals(function(1), 12)
+
+    def test_verdict_cache(self):
+        import hookutil
+
+        params = {'cache_dir': self.base, 'verdict_cache_size': '2'}
+        cache = hookutil.get_verdict_cache(params)
+        self.assertTrue(cache is hookutil.get_verdict_cache(params))
+
+        key = hookutil.settings_key('hook', {'a': 1, 'b': [2]})
+        self.assertEquals(key, hookutil.settings_key('hook', {'b': [2], 'a': 1}))
+        self.assertNotEquals(key, hookutil.settings_key('hook', {'a': 2, 'b': [2]}))
+
+        cache.put(key, '1' * 40, True)
+        cache.put(key, '2' * 40, [[1, 2, 'E101', 'text']])
+        self.assertEquals(cache.get(key, '1' * 40), True)
+        hookutil.cleanup()
+
+        cache = hookutil.get_verdict_cache(params)
+        self.assertEquals(cache.get(key, '1' * 40), True)
+        self.assertEquals(cache.get(key, '2' * 40), [[1, 2, 'E101', 'text']])
+        self.assertEquals(cache.get(key, '3' * 40), None)
+        self.assertEquals(cache.get('other', '1' * 40), None)
+        cache.flush()
+
+        # The least recently used verdict is evicted
+        sleep(1)
+        cache.get(key, '1' * 40)
+        cache.flush()
+        cache.put(key, '3' * 40, False)
+        hookutil.cleanup()
+
+        cache = hookutil.get_verdict_cache(params)
+        self.assertEquals(cache.get(key, '1' * 40), True)
+        self.assertEquals(cache.get(key, '2' * 40), None)
+        self.assertEquals(cache.get(key, '3' * 40), False)
+
+        # Passed commits are kept once the push is accepted
+        cache.validate(key, '4' * 40)
+        self.assertFalse(cache.is_validated(key, '4' * 40))
+        hookutil.cleanup()
+
+        cache = hookutil.get_verdict_cache(params)
+        self.assertFalse(cache.is_validated(key, '4' * 40))
+        cache.validate(key, '4' * 40)
+        hookutil.accept_push()
+        self.assertTrue(cache.is_validated(key, '4' * 40))
+        hookutil.cleanup()
+
+        cache = hookutil.get_verdict_cache(params)
+        self.assertTrue(cache.is_validated(key, '4' * 40))
+        self.assertFalse(cache.is_validated('other', '4' * 40))
+
+        self.assertEquals(hookutil.get_verdict_cache({'cache_dir': self.base, 'verdict_cache_size': '0'}), None)
+
+    def test_send_mail(self):
+        import hookutil
+
+        server = SMTPServer()
+        self.addCleanup(server.stop)
+
+        hookutil.send_mail({'a@example.com': 'to a', 'b@example.com': 'to b'},
+                           'githooks@example.com', 'subject', '127.0.0.1', server.port)
+        hookutil.send_mail({'a@example.com': 'to a again'},
+                           'githooks@example.com', 'subject', '127.0.0.1', server.port)
+        hookutil.send_mail({'a@example.com': 'about something else'},
+                           'githooks@example.com', 'other subject', '127.0.0.1', server.port)
+        self.assertEquals(server.mails, [])
+
+        hookutil.flush_mail()
+        hookutil.cleanup()
+
+        # All mails go over a single connection, one per recipient and subject
+        self.assertEquals(server.connections, 1)
+        self.assertEquals(sorted(rcpttos for mailfrom, rcpttos, data in server.mails),
+                          [['a@example.com'], ['a@example.com'], ['b@example.com']])
+        texts = [mail_text(data) for mailfrom, rcpttos, data in server.mails]
+        self.assertTrue(any('to a' in text and 'to a again' in text for text in texts))
+
+    def test_spool_mail(self):
+        import hookutil
+
+        server = SMTPServer()
+        self.addCleanup(server.stop)
+
+        spool_dir = os.path.join(self.base, 'spool')
+        spooled = lambda: [name for name in os.listdir(spool_dir) if name.endswith('.mail')]
+
+        hookutil.send_mail({'a@example.com': 'to a', 'b@example.com': 'to b'},
+                           'githooks@example.com', 'subject', '127.0.0.1', server.port, spool_dir)
+        hookutil.flush_mail()
+        self.assertEquals(len(spooled()), 2)
+        self.assertEquals(server.mails, [])
+
+        # The mails are sent in the background once the run is over
+        hookutil.cleanup()
+        wait_for(lambda: len(server.mails) == 2 and not spooled())
+        self.assertEquals(sorted(rcpttos for mailfrom, rcpttos, data in server.mails),
+                          [['a@example.com'], ['b@example.com']])
+
+    def test_spool_digest(self):
+        import hookutil
+
+        server = SMTPServer()
+        self.addCleanup(server.stop)
+
+        spool_dir = os.path.join(self.base, 'spool')
+
+        # Two pushes within the digest window
+        for text in ('first push', 'second push'):
+            hookutil.send_mail({'a@example.com': text}, 'githooks@example.com', 'subject',
+                               '127.0.0.1', server.port, spool_dir, '2')
+            hookutil.flush_mail()
+            hookutil.cleanup()
+
+        self.assertEquals(server.mails, [])
+        wait_for(lambda: server.mails)
+        sleep(0.5)
+
+        self.assertEquals(len(server.mails), 1)
+        text = mail_text(server.mails[0][2])
+        self.assertTrue('first push' in text and 'second push' in text)
+
+        # Flushers started while another waits for a digest exit at once
+        spool = lambda text: hookutil.spool_mail(spool_dir, '127.0.0.1', server.port, 'githooks@example.com',
+                                                 'b@example.com', 'subject', text, 1)
+        spool('third push')
+        flusher = threading.Thread(target=hookutil.flush_spool, args=(spool_dir,))
+        flusher.start()
+        sleep(0.2)
+        spool('fourth push')
+        hookutil.flush_spool(spool_dir)
+        self.assertEquals(len(server.mails), 1)
+        self.assertTrue(flusher.is_alive())
+
+        flusher.join()
+        self.assertEquals(len(server.mails), 2)
+        text = mail_text(server.mails[1][2])
+        self.assertTrue('third push' in text and 'fourth push' in text)
+
+
+class TestRejectMerge(TestBase):
+
+    def test_same_branch_merge(self):
+        write_string('a.txt', 'data')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        self.get_request()
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+        # Somebody else updates the remote branch
+        git(['checkout', '-b', 'remote', 'master'])
+        write_string('b.txt', 'data')
+        git(['add', 'b.txt'])
+        git(['commit', '-m', 'remote commit'])
+        git_call = git_async(['push', 'origin', 'remote:master'], self.repo)
+        self.get_request()
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+        # And the remote branch is merged into the local one
+        git(['checkout', 'master'])
+        write_string('c.txt', 'data')
+        git(['add', 'c.txt'])
+        git(['commit', '-m', 'local commit'])
+        git(['merge', '--no-edit', 'remote'])
+        git(['branch', '-D', 'remote'])
+
+        git_call = git_async(['push', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        hook = self.hooks["rejectmerge"]
+        permit, messages = hook.check(request[0], request[1], request[2])
+        self.assertFalse(permit)
+        self.assertEquals(len(messages), 1)
+        self.assertEquals(messages[0]['at'], request[2])
+        self.assertTrue("git pull --rebase origin master" in messages[0]['text'])
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_feature_merge(self):
+        write_string('a.txt', 'data')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git(['checkout', '-b', 'feature'])
+        write_string('b.txt', 'data')
+        git(['add', 'b.txt'])
+        git(['commit', '-m', 'feature'])
+        git_call = git_async(['push', 'origin', 'master', 'feature'], self.repo)
+        for i in range(2):
+            self.get_request()
+            self.write_response(0, 'success')
+        git_async_result(git_call)
+
+        git(['checkout', 'master'])
+        git(['merge', '--no-ff', '--no-edit', 'feature'])
+
+        git_call = git_async(['push', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        hook = self.hooks["rejectmerge"]
+        self.assertEquals(hook.check(request[0], request[1], request[2]), (True, []))
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+
 class TestLineEndings(TestBase):
 
     def test_get_attr(self):
@@ -221,6 +1110,112 @@ class TestLineEndings(TestBase):
         self.write_response(0, 'success')
         git_async_result(git_call)
 
+    def test_get_attrs(self):
+        write_string('a.txt', 'data')
+        write_string('b c.txt', 'data')
+        write_string('.gitattributes', 'a.txt binary\n*.txt owners=somebody@gmail.com')
+        git(['add', 'a.txt', 'b c.txt', '.gitattributes'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        import hookutil
+
+        attrs = hookutil.get_attrs(self.repo, request[2], ['a.txt', 'b c.txt', 'd.py'], ['binary', 'owners'])
+        self.assertEquals(attrs, {
+            'a.txt': {'binary': 'set', 'owners': 'somebody@gmail.com'},
+            'b c.txt': {'binary': 'unspecified', 'owners': 'somebody@gmail.com'},
+            'd.py': {'binary': 'unspecified', 'owners': 'unspecified'}
+        })
+        self.assertEquals(hookutil.get_attrs(self.repo, request[2], [], ['binary']), {})
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_has_mixed_le(self):
+        import line_endings
+
+        self.assertFalse(line_endings.has_mixed_le(['a\r\nb\r', '\nc\r\n']))
+        self.assertFalse(line_endings.has_mixed_le(['a\nb\n', 'c\rd\n']))
+        self.assertFalse(line_endings.has_mixed_le([]))
+        self.assertTrue(line_endings.has_mixed_le(['a\r\nb\r', '\nc\n']))
+        self.assertTrue(line_endings.has_mixed_le(['a\r\n', 'b\n', 'never read']))
+
+        # Stops reading once both are seen
+        def chunks():
+            yield 'a\r\nb\n'
+            raise AssertionError('read too far')
+        self.assertTrue(line_endings.has_mixed_le(chunks()))
+
+    def test_max_scan_bytes(self):
+        git(['config', 'core.autocrlf', 'false'])
+        write_string('a.txt', 'data\r\n' * 100 + 'data\n')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        hook = self.hooks["line_endings"]
+        self.assertFalse(hook.check(request[0], request[1], request[2])[0])
+
+        import line_endings
+        hook = line_endings.Hook(self.remote_repo, [], dict(hook.params, max_scan_bytes='100'))
+        self.assertTrue(hook.check(request[0], request[1], request[2])[0])
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_tip_mode(self):
+        git(['config', 'core.autocrlf', 'false'])
+        write_string('base.txt', 'data\n')
+        git(['add', 'base.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        self.get_request()
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+        write_string('a.txt', 'data\r\n\n')
+        write_string('b.txt', 'data\r\n\n')
+        git(['add', 'a.txt', 'b.txt'])
+        git(['commit', '-m', 'second commit'])
+        second = git(['rev-parse', 'HEAD']).strip()
+        write_string('a.txt', 'data\n\n')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'fix a.txt'])
+        git_call = git_async(['push', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        hook = self.hooks["line_endings"]
+        permit, messages = hook.check(request[0], request[1], request[2])
+        self.assertFalse(permit)
+        self.assertEquals(sorted((message['at'], message['text']) for message in messages), [
+            (second, "Error: file 'a.txt' has mixed line endings (CRLF/LF)"),
+            (second, "Error: file 'b.txt' has mixed line endings (CRLF/LF)")
+        ])
+
+        # Only the final contents are checked
+        hook.mode = 'tip'
+        permit, messages = hook.check(request[0], request[1], request[2])
+        self.assertFalse(permit)
+        self.assertEquals(messages, [
+            {'at': request[2], 'text': "Error: file 'b.txt' has mixed line endings (CRLF/LF)"}
+        ])
+
+        # A new branch is compared with the parent of its oldest commit
+        import hookutil
+        modfiles = hookutil.parse_git_tip(self.remote_repo, 'refs/heads/other', '0' * 40, request[2],
+                                          this_branch_only=False)
+        self.assertEquals(sorted((modfile['status'], modfile['path']) for modfile in modfiles),
+                          [('A', 'a.txt'), ('A', 'b.txt')])
+
+        # A root commit is compared with the empty tree
+        modfiles = hookutil.parse_git_tip(self.remote_repo, 'refs/heads/master', '0' * 40, request[1])
+        self.assertEquals([(modfile['status'], modfile['path']) for modfile in modfiles], [('A', 'base.txt')])
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
     def test_successful_hook(self):
         write_string('a.txt', 'data\n')
         write_string('.gitattributes', 'a.txt text')
@@ -259,6 +1254,115 @@ class TestLineEndings(TestBase):
             "Error: file 'b.txt' has mixed line endings (CRLF/LF)"
         ])
 
+        # Verdicts are cached
+        import hookutil
+        hookutil.cleanup()
+        self.assertEquals(hook.check(request[0], request[1], request[2]), (permit, messages))
+        self.assertEquals(hookutil.get_verdict_cache(hook.params).misses, 0)
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+
+class TestPep8(TestBase):
+
+    def test_successful_hook(self):
+        write_string('a.py', 'import os\n')
+        write_string('b.txt', 'import os,sys\n')
+        git(['add', 'a.py', 'b.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        hook = self.hooks["pep8hook"]
+        self.assertEquals(hook.check(request[0], request[1], request[2]), (True, []))
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+    def test_failed_hook(self):
+        write_string('a.py', 'import os,sys\n')
+        git(['add', 'a.py'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        self.get_request()
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+        os.mkdir('lib')
+        write_string('lib/b.py', 'x=1\n' + 'y = 1  # ' + 'z' * 100 + '\n')
+        write_string('a.py', 'import os,sys\nimport re,json\n')
+        git(['add', 'a.py', 'lib/b.py'])
+        git(['commit', '-m', 'second commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        hook = self.hooks["pep8hook"]
+        permit, messages = hook.check(request[0], request[1], request[2])
+        self.assertFalse(permit)
+        self.assertEquals(messages, [
+            {'at': request[2], 'text': "a.py:2:10: E231 missing whitespace after ','"},
+            {'at': request[2], 'text': "a.py:2:10: E401 multiple imports on one line"},
+            {'at': request[2], 'text': "lib/b.py:1:2: E225 missing whitespace around operator"}
+        ])
+
+        # Results cached by another pycodestyle version are not used
+        import hookutil
+        import pycodestyle
+        hookutil.cleanup()
+        self.addCleanup(setattr, pycodestyle, '__version__', pycodestyle.__version__)
+        pycodestyle.__version__ += '.test'
+        self.assertEquals(hook.check(request[0], request[1], request[2]), (permit, messages))
+        self.assertEquals(hookutil.get_verdict_cache(hook.params).hits, 0)
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
+
+class TestCopyright(TestBase):
+
+    def test_has_good_copyright(self):
+        import copyright
+
+        copyrights = [('Copyright ', 'Copyright 2017 Foo'), ('\\(c\\) ', '\\(c\\) Foo')]
+        patterns, any_start = copyright.compile_copyrights(copyrights)
+        self.assertTrue(any_start is not None)
+
+        for any_start in (any_start, None):
+            self.assertTrue(copyright.has_good_copyright('no copyright', patterns, any_start))
+            self.assertTrue(copyright.has_good_copyright('Copyright 2017 Foo', patterns, any_start))
+            self.assertFalse(copyright.has_good_copyright('Copyright 2016 Foo', patterns, any_start))
+            self.assertFalse(copyright.has_good_copyright('Copyright 2017 Foo\n(c) Bar', patterns, any_start))
+
+        # Starts with flags are checked one by one
+        self.assertEquals(copyright.compile_copyrights([('(?i)copyright', 'x'), ('(c)', 'y')])[1], None)
+        named = [('(?P<y>\\d{4}) Foo', 'x'), ('(?P<y>\\d{4}) Bar', 'y')]
+        self.assertEquals(copyright.compile_copyrights(named)[1], None)
+        with self.assertRaises(RuntimeError):
+            copyright.compile_copyrights([('(', 'x')])
+
+    def test_header_window(self):
+        write_string('a.txt', 'line\n' * 20 + 'Copyright 2001 Foo\n')
+        git(['add', 'a.txt'])
+        git(['commit', '-m', 'initial commit'])
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        import copyright
+
+        settings = [{'start': 'Copyright ', 'full': 'Copyright %Y Foo'}]
+        params = self.hooks['line_endings'].params
+
+        hook = copyright.Hook(self.remote_repo, settings, params)
+        self.assertFalse(hook.check(request[0], request[1], request[2])[0])
+
+        for window in ({'header_lines': '20'}, {'header_bytes': '100'}):
+            hook = copyright.Hook(self.remote_repo, settings, dict(params, **window))
+            self.assertTrue(hook.check(request[0], request[1], request[2])[0])
+
+        hook = copyright.Hook(self.remote_repo, settings, dict(params, header_lines='21'))
+        self.assertFalse(hook.check(request[0], request[1], request[2])[0])
+
         self.write_response(0, 'success')
         git_async_result(git_call)
 
@@ -386,9 +1490,51 @@ class TestNotify(TestBase):
         self.write_response(0, 'success')
         git_async_result(git_call)
 
+    def test_match_attr(self):
+        os.makedirs('docs/api')
+        os.makedirs('src/lib')
+        write_string('.gitattributes', '*.txt owners=a@gmail.com\n'
+                                       '/top.c owners=b@gmail.com\n'
+                                       'docs/** owners=c@gmail.com\n'
+                                       'src/*.c owners=d@gmail.com\n'
+                                       'src/lib/ owners=e@gmail.com\n'
+                                       '"q u.txt" owners\n'
+                                       '# comment\n')
+        write_string('docs/api/.gitattributes', '*.txt -owners\n'
+                                                'keep.txt !owners\n'
+                                                'x?.py owners=f@gmail.com\n')
+        write_string('src/lib/.gitattributes', '[ab].c owners=g@gmail.com\n')
+        paths = ['a.txt', 'top.c', 'src/top.c', 'docs/a.md', 'docs/api/a.txt', 'docs/api/keep.txt',
+                 'docs/api/x1.py', 'docs/api/xy.py', 'src/a.c', 'src/lib/a.c', 'src/lib/c.c',
+                 'src/lib/b.txt', 'q u.txt', 'info.cfg']
+        for path in paths:
+            write_string(path, 'data')
+        git(['add', '.'])
+        git(['commit', '-m', 'initial commit'])
+        write_string(os.path.join('.git', 'info', 'attributes'), '*.cfg owners=h@gmail.com\n')
+
+        git_call = git_async(['push', '-u', 'origin', 'master'], self.repo)
+        request = self.get_request()
+
+        import hookutil
+
+        attrs = hookutil.get_attrs(self.repo, request[2], paths + ['no/such/file.txt'], ['owners'])
+        owners = hookutil.match_attr(self.repo, request[2], paths + ['no/such/file.txt'], 'owners')
+        self.assertEquals(owners, dict((path, attrs[path]['owners']) for path in attrs))
+        self.assertEquals(owners['src/lib/a.c'], 'g@gmail.com')
+
+        self.write_response(0, 'success')
+        git_async_result(git_call)
+
     def test_successful_hook_send(self):
+        import hookutil
+
+        server = SMTPServer()
+        self.addCleanup(server.stop)
+
         hook = self.hooks["notify"]
-        assert hook.params['smtp_from'], 'please configure smtp_from to run this test'
+        hook.params.update({'smtp_server': '127.0.0.1', 'smtp_port': server.port,
+                            'smtp_from': 'githooks@example.com'})
 
         write_string('a.txt', 'data')
         write_string('b.txt', 'data')
@@ -419,6 +1565,11 @@ class TestNotify(TestBase):
             "refs/heads/master"
         ]
         hook.check(request[0], request[1], request[2])
+        hookutil.flush_mail()
+
+        self.assertEquals(len(server.mails), 1)
+        self.assertEquals(server.mails[0][:2], ('githooks@example.com', ['githooks@example.com']))
+        self.assertTrue('Hook notify' in server.mails[0][2])
 
         self.write_response(0, 'success')
         git_async_result(git_call)